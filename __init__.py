@@ -38,6 +38,21 @@ class EGGAnimationProperty(bpy.types.PropertyGroup):
     from_frame: IntProperty(name = "From", default = 1)
     to_frame: IntProperty(name = "To", default = 2)
     fps: IntProperty(name = "FPS", default = 24)
+    bone_mask: EnumProperty(
+        name = "Bones",
+        description = "Bones, which the animation is exported for",
+        items = (
+            ('ALL', "All", "Export all bones"),
+            ('INCLUDE', "Include", "Export only the listed bones"),
+            ('EXCLUDE', "Exclude", "Export all bones except the listed ones"),
+        ),
+        default = 'ALL',
+    )
+    bone_names: StringProperty(
+        name = "Bone names",
+        description = "Comma separated names of the bones or the bone collections",
+        default = "",
+    )
 
     def __get_idx(self):
         return list(bpy.context.scene.yabee_settings.opt_anim_list.anim_collection).index(self)
@@ -53,7 +68,11 @@ class EGGAnimList(bpy.types.PropertyGroup):
     def get_anim_dict(self):
         anim_dict = {}
         for anim in self.anim_collection:
-            anim_dict[anim.name] = (anim.from_frame, anim.to_frame, anim.fps)
+            if anim.bone_mask == 'ALL':
+                anim_dict[anim.name] = (anim.from_frame, anim.to_frame, anim.fps)
+            else:
+                names = [name.strip() for name in anim.bone_names.split(',') if name.strip()]
+                anim_dict[anim.name] = (anim.from_frame, anim.to_frame, anim.fps, (anim.bone_mask, names))
         return anim_dict
 
 
@@ -121,7 +140,7 @@ class YABEEProperty(bpy.types.PropertyGroup):
 
     opt_merge_actor: BoolProperty(
         name = "Merge actor",
-        description = "Merge meshes, armatured by single Armature",
+        description = "Merge meshes, armatured by single Armature, into one vertex pool",
         default = False,
     )
 
@@ -155,6 +174,101 @@ class YABEEProperty(bpy.types.PropertyGroup):
         default = False,
     )
 
+    opt_weld_vertices: BoolProperty(
+        name = "Weld vertices",
+        description = "Merge polygon corners with identical attributes into shared EGG vertices",
+        default = False,
+    )
+
+    opt_direct_fcurves: BoolProperty(
+        name = "Evaluate F-curves directly",
+        description = "Compute bones and shape keys without constraints and drivers straight from "
+                      "the action's F-curves instead of evaluating the scene on each frame",
+        default = True,
+    )
+
+    opt_skip_static_frames: BoolProperty(
+        name = "Skip static frames",
+        description = "Sample only the frames, where the F-curve keys change the values, "
+                      "and hold the rest. Rigs with constraints and drivers skip only the frames "
+                      "before the first and after the last key",
+        default = False,
+    )
+
+    opt_compact_anims: BoolProperty(
+        name = "Compact animation tables",
+        description = "Write joint animations per channel: constant channels once, "
+                      "channels at their default value are omitted",
+        default = True,
+    )
+
+    opt_simplify_anims: BoolProperty(
+        name = "Simplify animations",
+        description = "Snap near-constant channels and lower the fps of animations, "
+                      "while the result stays within the tolerances",
+        default = False,
+    )
+
+    opt_rotation_tolerance: FloatProperty(
+        name = "Rotation tolerance",
+        description = "Max allowed rotation error, in degrees",
+        default = 0.05,
+        min = 0.0,
+    )
+
+    opt_unit_tolerance: FloatProperty(
+        name = "Unit tolerance",
+        description = "Max allowed error of translation, scale and shape key values",
+        default = 0.001,
+        min = 0.0,
+    )
+
+    opt_prune_joints: BoolProperty(
+        name = "Prune joints",
+        description = "Export only the bones with vertex weights or attached objects "
+                      "and their parents, drop IK targets, poles and other helper bones",
+        default = False,
+    )
+
+    opt_instance_meshes: BoolProperty(
+        name = "Instance shared meshes",
+        description = "Write meshes, linked to several objects or identical, once to separate "
+                      "EGG files and reference them from each object",
+        default = False,
+    )
+
+    opt_instance_collections: BoolProperty(
+        name = "Instance collections",
+        description = "Write collections, instanced by empties, once to separate "
+                      "'<collection>.egg' files and reference them from each empty",
+        default = False,
+    )
+
+    opt_max_influences: IntProperty(
+        name = "Max joint influences",
+        description = "Keep only the strongest joint weights per vertex and renormalize them (0 - unlimited)",
+        default = 0,
+        min = 0,
+        max = 16,
+    )
+
+    opt_weight_bits: IntProperty(
+        name = "Weight bits",
+        description = "Quantize joint weights to N bits (8 - steps of 1/255) and renormalize them, "
+                      "so vertices share <VertexRef> entries (0 - exact weights)",
+        default = 0,
+        min = 0,
+        max = 16,
+    )
+
+    opt_float_accuracy: IntProperty(
+        name = "Float accuracy",
+        description = "Number of digits after the decimal point for the written values",
+        default = 6,
+        min = 1,
+        max = 12,
+    )
+
     opt_anim_list: PointerProperty(type = EGGAnimList)
 
     first_run: BoolProperty(default = True)
@@ -166,6 +280,8 @@ class YABEEProperty(bpy.types.PropertyGroup):
 
         layout.row().label(text = 'Animation:')
         layout.row().prop(self, 'opt_anims_from_actions')
+        layout.row().prop(self, 'opt_direct_fcurves')
+        layout.row().prop(self, 'opt_skip_static_frames')
         if not self.opt_anims_from_actions:
             row = layout.row()
             row.template_list(
@@ -188,12 +304,22 @@ class YABEEProperty(bpy.types.PropertyGroup):
                 row.prop(p, 'from_frame')
                 row.prop(p, 'to_frame')
                 row.prop(p, 'fps')
+                row = layout.row(align = True)
+                row.prop(p, 'bone_mask')
+                if p.bone_mask != 'ALL':
+                    row.prop(p, 'bone_names', text = "")
 
         layout.separator()
 
         layout.row().label(text = 'Options:')
         layout.row().prop(self, 'opt_anim_only')
         layout.row().prop(self, 'opt_separate_anim_files')
+        layout.row().prop(self, 'opt_compact_anims')
+        layout.row().prop(self, 'opt_simplify_anims')
+        if self.opt_simplify_anims:
+            row = layout.row(align = True)
+            row.prop(self, 'opt_rotation_tolerance')
+            row.prop(self, 'opt_unit_tolerance')
         if not self.opt_anim_only:
             layout.row().prop(self, 'opt_tbs_proc')
 
@@ -221,6 +347,13 @@ class YABEEProperty(bpy.types.PropertyGroup):
 
             layout.row().prop(self, 'opt_export_pbs')
             layout.row().prop(self, 'opt_force_export_vertex_colors')
+            layout.row().prop(self, 'opt_weld_vertices')
+            layout.row().prop(self, 'opt_instance_meshes')
+            layout.row().prop(self, 'opt_instance_collections')
+            layout.row().prop(self, 'opt_max_influences')
+            layout.row().prop(self, 'opt_weight_bits')
+        layout.row().prop(self, 'opt_prune_joints')
+        layout.row().prop(self, 'opt_float_accuracy')
 
     def get_bake_dict(self):
         texture_bake_dict = {}
@@ -283,6 +416,19 @@ class YABEEProperty(bpy.types.PropertyGroup):
         self.opt_use_loop_normals = False
         self.opt_export_pbs = False
         self.opt_force_export_vertex_colors = False
+        self.opt_weld_vertices = False
+        self.opt_instance_meshes = False
+        self.opt_instance_collections = False
+        self.opt_max_influences = 0
+        self.opt_weight_bits = 0
+        self.opt_prune_joints = False
+        self.opt_direct_fcurves = True
+        self.opt_skip_static_frames = False
+        self.opt_compact_anims = True
+        self.opt_simplify_anims = False
+        self.opt_rotation_tolerance = 0.05
+        self.opt_unit_tolerance = 0.001
+        self.opt_float_accuracy = 6
         while self.opt_anim_list.anim_collection[:]:
             bpy.ops.export.egg_anim_remove('INVOKE_DEFAULT')
         self.first_run = False
@@ -391,7 +537,19 @@ class ExportPanda3DEGG(bpy.types.Operator, ExportHelper):
             sett.opt_pview,
             sett.opt_use_loop_normals,
             sett.opt_export_pbs,
-            sett.opt_force_export_vertex_colors
+            sett.opt_force_export_vertex_colors,
+            weld_vertices = sett.opt_weld_vertices,
+            max_influences = sett.opt_max_influences,
+            weight_bits = sett.opt_weight_bits,
+            float_accuracy = sett.opt_float_accuracy,
+            direct_fcurves = sett.opt_direct_fcurves,
+            compact_anims = sett.opt_compact_anims,
+            anim_tolerances = (sett.opt_rotation_tolerance, sett.opt_unit_tolerance)
+            if sett.opt_simplify_anims else None,
+            skip_static_frames = sett.opt_skip_static_frames,
+            prune_joints = sett.opt_prune_joints,
+            instance_meshes = sett.opt_instance_meshes,
+            instance_collections = sett.opt_instance_collections
         )
 
         if errors:
@@ -442,22 +600,6 @@ def register():
 
     # Good or bad, but I'll store settings in the scene
     bpy.types.Scene.yabee_settings = PointerProperty(type = YABEEProperty)
-    # Hack again. I use custom property to be able to get basic object name in the copy of the scene.
-    bpy.types.Object.yabee_name = StringProperty(name = "YABEE_Name", default = "Unknown")
-    bpy.types.Mesh.yabee_name = StringProperty(name = "YABEE_Name", default = "Unknown")
-    bpy.types.Material.yabee_name = StringProperty(name = "YABEE_Name", default = "Unknown")
-    # Can't directly add property to MaterialTextureSlot ("this type doesn't support IDProperties"),
-    # so this stores original names for each embedded texture slot
-    # in a string like: "Texture\1Texture2\1..." (see NAME_SEPARATOR)
-    bpy.types.Material.yabee_texture_slots = StringProperty(name = "YABEE_Texture_Slots", default = "Unknown")
-    bpy.types.Texture.yabee_name = StringProperty(name = "YABEE_Name", default = "Unknown")
-    bpy.types.Armature.yabee_name = StringProperty(name = "YABEE_Name", default = "Unknown")
-    bpy.types.Curve.yabee_name = StringProperty(name = "YABEE_Name", default = "Unknown")
-    # bpy.types.ShapeKey.yabee_name = StringProperty(name="YABEE_Name", default="Unknown")
-    bpy.types.Key.yabee_name = StringProperty(name = "YABEE_Name", default = "Unknown")
-    bpy.types.Image.yabee_name = StringProperty(name = "YABEE_Name", default = "Unknown")
-    bpy.types.Bone.yabee_name = StringProperty(name = "YABEE_Name", default = "Unknown")
-    bpy.types.PoseBone.yabee_name = StringProperty(name = "YABEE_Name", default = "Unknown")
 
     if bpy.app.version < (2, 80):
         bpy.types.INFO_MT_file_export.append(menu_func_export)
@@ -6,7 +6,9 @@ import sys
 # file name to write
 FILE_PATH = './exp_test/test.egg'
 
-# { 'animation_name' : (start_frame, end_frame, frame_rate) }
+# { 'animation_name' : (start_frame, end_frame, frame_rate[, bone_mask]) }
+# bone_mask is ('INCLUDE' or 'EXCLUDE', [bone or bone collection names]),
+# e.g. 'wave': (0, 20, 24, ('INCLUDE', ['upper_arm.R', 'forearm.R', 'hand.R']))
 ANIMATIONS = {
     'anim1': (0, 10, 5),
 }
@@ -32,7 +34,7 @@ SEPARATE_ANIM_FILE = True
 ANIM_ONLY = False
 
 # number of sign after point
-FLOATING_POINT_ACCURACY = 3
+FLOATING_POINT_ACCURACY = 6
 
 # Enable tangent space calculation. Tangent space needed for some
 # shaders/autoshaders, but increase exporting time
@@ -42,6 +44,46 @@ FLOATING_POINT_ACCURACY = 3
 # 'NO' - do not calc TBS
 CALC_TBS = 'PANDA'
 
+# 'True' to merge polygon corners with identical attributes into shared vertices
+WELD_VERTICES = False
+
+# 'True' to write meshes, linked to several objects or identical, once to
+# separate '<file>-<mesh>.egg' files, which the objects reference with <File>
+INSTANCE_MESHES = False
+
+# 'True' to write collections, instanced by empties, once to separate
+# '<collection>.egg' files, which the empties reference with <File>
+INSTANCE_COLLECTIONS = False
+
+# Max number of joints, affecting one vertex. The weakest weights are
+# dropped and the rest are renormalized. 0 - unlimited
+MAX_INFLUENCES = 0
+
+# Bits per joint weight (8 - steps of 1/255). The weights are quantized and
+# renormalized, so vertices share <VertexRef> entries. 0 - exact weights
+WEIGHT_BITS = 0
+
+# 'True' to export only the bones with vertex weights or attached objects and
+# their parents, in both the skeleton and the animations
+PRUNE_JOINTS = False
+
+# 'True' to compute bones and shape keys without constraints and drivers
+# straight from the action's F-curves instead of setting each frame
+DIRECT_FCURVES = True
+
+# 'True' to write joint animations per channel (<Xfm$Anim_S$>): constant
+# channels are written once, channels at the default value are omitted
+COMPACT_ANIMS = True
+
+# (rotation in degrees, units) max errors to simplify animations with: near-constant
+# channels are snapped and the fps is lowered where possible. None - don't simplify
+ANIM_TOLERANCES = None
+
+# 'True' to sample only the frames, where the F-curve keys change the values,
+# and hold the rest (padding around the keys, holds between the keys).
+# Rigs with constraints and drivers skip the padding around the keys only
+SKIP_STATIC_FRAMES = False
+
 # Type of texture processing. May be 'SIMPLE' or 'BAKE'.
 # 'SIMPLE' - export all texture layers as MODULATE.
 # Exceptions:
@@ -95,5 +137,16 @@ if __name__ == '__main__':
         BAKE_LAYERS,
         True, True, True,  # MERGE_ACTOR_MESH, APPLY_MOD, PVIEW
         False, False,  # USE_LOOP_NORMALS, EXPORT_PBS
-        False  # FORCE_EXPORT_VERTEX_COLORS
+        False,  # FORCE_EXPORT_VERTEX_COLORS
+        weld_vertices = WELD_VERTICES,
+        max_influences = MAX_INFLUENCES,
+        weight_bits = WEIGHT_BITS,
+        float_accuracy = FLOATING_POINT_ACCURACY,
+        direct_fcurves = DIRECT_FCURVES,
+        compact_anims = COMPACT_ANIMS,
+        anim_tolerances = ANIM_TOLERANCES,
+        skip_static_frames = SKIP_STATIC_FRAMES,
+        prune_joints = PRUNE_JOINTS,
+        instance_meshes = INSTANCE_MESHES,
+        instance_collections = INSTANCE_COLLECTIONS
     )
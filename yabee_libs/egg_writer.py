@@ -1,9 +1,13 @@
 from mathutils import *
-from math import pi
 # from .texture_processor import PbrTextures, TextureBaker
 from .texture_processor import PbrTextures
 
 from .utils import *
+import numpy as np
+import bmesh
+import io
+import hashlib
+import re
 import sys
 import subprocess
 import importlib
@@ -29,14 +33,86 @@ PVIEW = True
 EXPORT_PBS = False
 FORCE_EXPORT_VERTEX_COLORS = False
 USE_LOOP_NORMALS = False
-STRF = lambda x: '%.6f' % x
+WELD_VERTICES = False
+MAX_INFLUENCES = 0  # joints per vertex, 0 - unlimited
+WEIGHT_BITS = 0  # bits per joint weight, 0 - exact weights
+DIRECT_FCURVES = True
+COMPACT_ANIMS = True
+ANIM_TOLERANCES = None  # (degrees, units) or None
+SKIP_STATIC_FRAMES = False
+PRUNE_JOINTS = False
+INSTANCE_MESHES = False
+INSTANCE_COLLECTIONS = False
+STRF = FloatFormatter(6)
+BATCH_SIZE = 4096  # vertices or polygons formatted per call
 USED_MATERIALS = set()  # type: set
 USED_TEXTURES = {}  # type: dict
+EXPORT_MESHES = {}  # type: dict
+KEPT_JOINTS = {}  # type: dict
+SKELETONS = {}  # type: dict
+MERGED_ACTORS = {}  # type: dict
+SHARED_MESHES = {}  # type: dict
+INSTANCED_COLLECTIONS = {}  # type: dict
 
 # const used to pack string array into StringProperty
 NAME_SEPARATOR = "\1"
 
 
+# -----------------------------------------------------------------------
+#                           OUTPUT STREAM
+# -----------------------------------------------------------------------
+class EGGStream:
+    """
+    Line by line EGG output into the (buffered) file handle.
+    The nesting level is kept as state, so the nested structures are written once
+    without building and re-indenting the strings of the children.
+    """
+
+    def __init__(self, handle, indent='  '):
+        self.handle = handle
+        self.indent = indent
+        self.level = 0
+        self.prefix = ''
+
+    def push(self):
+        self.level += 1
+        self.prefix = self.indent * self.level
+
+    def pop(self):
+        self.level -= 1
+        self.prefix = self.indent * self.level
+
+    def write_line(self, line):
+        self.handle.write(self.prefix + line + '\n')
+
+    def write_lines(self, text):
+        """
+        Write the multiline string, indenting every line to the current level.
+        """
+        for line in text.splitlines():
+            self.write_line(line)
+
+    def open(self, header):
+        """
+        Start the EGG entry "header {" and indent the next lines.
+        """
+        self.write_line(header + ' {')
+        self.push()
+
+    def close(self):
+        self.pop()
+        self.write_line('}')
+
+
+def get_egg_str(write, *args):
+    """
+    Run the stream writer function with the in-memory buffer and return the written EGG string.
+    """
+    buffer = io.StringIO()
+    write(EGGStream(buffer), *args)
+    return buffer.getvalue()
+
+
 class Group:
     """
     Representation of the EGG <Group> hierarchy structure as the linked list "one to many".
@@ -53,8 +129,11 @@ class Group:
 
         if self.object and self.object.__class__ != bpy.types.Bone:
             if self.object.type == 'MESH':
+                if self.object.name in SHARED_MESHES:
+                    # The mesh is written once to the separate file, see write_shared_meshes()
+                    self._yabee_object = EGGInstanceObjectData(self.object, SHARED_MESHES[self.object.name][0])
                 # We are a mesh with an armature modifier, we shall be considered an actor.
-                if 'ARMATURE' in [m.type for m in self.object.modifiers]:
+                elif 'ARMATURE' in [m.type for m in self.object.modifiers]:
                     self._yabee_object = EGGActorObjectData(self.object)
                 else:
                     self._yabee_object = EGGMeshObjectData(self.object)
@@ -64,43 +143,70 @@ class Group:
             # Does this ever get called, and how?
             elif self.object.type == 'ARMATURE':
                 pass
+            elif INSTANCE_COLLECTIONS and self.object.type == 'EMPTY' and \
+                    self.object.instance_type == 'COLLECTION' and self.object.instance_collection:
+                # The collection is written to the separate file, see write_instanced_collections()
+                file_name = get_collection_file_name(self.object.instance_collection)
+                self._yabee_object = EGGInstanceObjectData(self.object, file_name)
             else:
                 self._yabee_object = EGGBaseObjectData(self.object)
 
-    def update_joints_data(self, actor_data_list=None):
-        if actor_data_list is None:
-            actor_data_list = []
-            hierarchy_to_list(self, actor_data_list, base_filter = EGGActorObjectData)
-
+    def update_joints_data(self):
+        """
+        Create the joints data with the vertex references, collected by the skeletons of the actors.
+        """
         if not self._yabee_object and self.object and self.object.__class__ == bpy.types.Bone:
-            vref = []
-            for actor_data in actor_data_list:
-                if self.object.name in actor_data._yabee_object.joint_vtx_ref.keys():
-                    vref.append(actor_data._yabee_object.joint_vtx_ref[self.object.name])
-            self._yabee_object = EGGJointObjectData(self.object, vref, self.arm_owner)
+            skeleton = get_skeleton(self.arm_owner)
+            self._yabee_object = EGGJointObjectData(self.object, skeleton.vrefs.get(self.object.name, []),
+                                                    self.arm_owner)
+
+        for child in self.children:
+            child.update_joints_data()
+
+    def prune_joints(self, kept_joints):
+        """
+        Remove the joints, which are not kept, with their subtrees.
 
+        @param kept_joints: dict {armature name: set of bone names}, see get_kept_joints().
+        """
+        self.children = [child for child in self.children
+                         if child.object.__class__ != bpy.types.Bone or
+                         child.object.name in kept_joints.get(child.arm_owner.name, (child.object.name,))]
         for child in self.children:
-            child.update_joints_data(actor_data_list)
-
-    def check_parenting(self, p, o, obj_list):
-        # 0 - Not
-        # 1 - Object to object
-        # 2 - Bone to Bone
-        # 3 - Object to Bone
-        if o.__class__ == bpy.types.Bone and not o.parent:
-            return 0
-        if p.__class__ != bpy.types.Bone and o.parent == p and not (p and p.type == 'ARMATURE' and o.parent_bone):
-            return 1
-        if not p and (str(o.parent) not in map(str, obj_list)):
-            return 1
-        if p and p.__class__ == bpy.types.Bone and o.__class__ == bpy.types.Bone and o.parent == p:
-            return 2
-        # ACHTUNG!!! Be careful: If we have two armatures with the
-        # same bones name and object, attached to it,
-        # then we can get unexpected results!
-        if o.__class__ != bpy.types.Bone and o.parent_type == 'BONE' and p and o.parent_bone == p.name:
-            return 3
-        return 0
+            child.prune_joints(kept_joints)
+
+    @staticmethod
+    def get_children_index(obj_list):
+        """
+        Map the parents to their children, in the order of obj_list. The key is None for the
+        top level objects, the object name for children of the object and the tuple
+        (armature name, bone name) for children of the bone: objects parented to
+        the bone go first, then the child bones.
+
+        @param obj_list: tuple or list of blender's objects.
+        @return: dict {key: [children]}.
+        """
+        children_index = {}
+        names = {obj.name for obj in obj_list}
+        armatures = []
+        for obj in obj_list:
+            if obj.type == 'ARMATURE':
+                armatures.append(obj)
+            parent = get_export_parent(obj)
+            if not parent or parent.name not in names:
+                key = None
+            elif parent == obj.parent and parent.type == 'ARMATURE' and \
+                    obj.parent_type == 'BONE' and obj.parent_bone:
+                key = (parent.name, obj.parent_bone)
+            else:
+                key = parent.name
+            children_index.setdefault(key, []).append(obj)
+
+        for arm in armatures:
+            for parent_name, bones in get_skeleton(arm).children_index.items():
+                if parent_name:
+                    children_index.setdefault((arm.name, parent_name), []).extend(bones)
+        return children_index
 
     def make_hierarchy_from_list(self, obj_list):
         """
@@ -111,37 +217,40 @@ class Group:
         @param obj_list: tuple or list of blender's objects.
         """
         try:
-            if self.object and self.object.__class__ != bpy.types.Bone and self.object.type == 'ARMATURE':
-                obj_list += self.object.data.bones
-                for bone in self.object.data.bones:
-                    if not bone.parent:
-                        try:
-                            group = self.__class__(bone, self.object)  # type: Group
-                        except:
-                            print_exc()
-                            return ['ERR_MK_OBJ', ]
-                        self.children.append(group)
-                        group.make_hierarchy_from_list(obj_list)
-            for obj in obj_list:
-                # If we have a relationship with the current blender objects, whether by obj2obj, bone2bone, or bone2obj
-                if self.check_parenting(self.object, obj, obj_list) > 0:
-                    if obj.__class__ == bpy.types.Bone:
-                        try:
-                            group = self.__class__(obj, self.arm_owner)
-                        except:
-                            print_exc()
-                            return ['ERR_MK_OBJ', ]
-                    else:
-                        try:
-                            group = self.__class__(obj)
-                        except:
-                            print_exc()
-                            return ['ERR_MK_OBJ', ]
-                    self.children.append(group)
-                    group.make_hierarchy_from_list(obj_list)
+            return self.make_hierarchy_from_index(self.get_children_index(obj_list))
         except Exception as exc:
             print_exc()
             return ['ERR_MK_HIERARCHY', ]
+
+    def make_hierarchy_from_index(self, children_index):
+        """
+        Make the <Group> hierarchy under self.object from the index,
+        returned by get_children_index().
+
+        @param children_index: dict {key: [children]}.
+        """
+        arm_owner = self.arm_owner
+        children = []
+        if not self.object:
+            children = children_index.get(None, [])
+        elif self.object.__class__ == bpy.types.Bone:
+            children = children_index.get((self.arm_owner.name, self.object.name), [])
+        else:
+            if self.object.type == 'ARMATURE':
+                arm_owner = self.object
+                children = get_skeleton(self.object).children_index.get(None, [])
+            children = children + children_index.get(self.object.name, [])
+
+        for obj in children:
+            try:
+                group = self.__class__(obj, arm_owner)  # type: Group
+            except:
+                print_exc()
+                return ['ERR_MK_OBJ', ]
+            self.children.append(group)
+            errors = group.make_hierarchy_from_index(children_index)
+            if errors:
+                return errors
         return []
 
     def print_hierarchy(self, level=0):
@@ -154,28 +263,27 @@ class Group:
         for child in self.children:
             child.print_hierarchy(level + 1)
 
-    def get_full_egg_str(self, level=0):
-        return ''.join(self.get_full_egg_str_arr(level))
+    def get_full_egg_str(self):
+        return get_egg_str(self.write_egg)
 
-    def get_full_egg_str_arr(self, level=0):
+    def write_egg(self, stream):
         """
-        Create and return representation of the EGG  <Group> with hierarchy, started from self.object.
+        Write representation of the EGG <Group> with hierarchy, started from self.object.
         It's start point to generating EGG structure.
 
-        @param level: starting indent level.
-
-        @return: full EGG string of group.
+        @param stream: EGGStream to write.
         """
-        egg_str = []
-
         if self.object:
+            if isinstance(self._yabee_object, EGGActorObjectData) and \
+                    not self._yabee_object.merged_parts and not self.children:
+                # Merged into the vertex pool of another actor
+                return
 
             # Add the header for this container
-            # Todo: Support for <Instance>
             if self.object.__class__ == bpy.types.Bone:
-                egg_str.append('%s<Joint> %s {\n' % ('  ' * level, eggSafeName(self.object.yabee_name)))
+                stream.open('<Joint> %s' % eggSafeName(self.object.name))
             else:
-                egg_str.append('%s<Group> %s {\n' % ('  ' * level, eggSafeName(self.object.yabee_name)))
+                stream.open('<Group> %s' % eggSafeName(self.object.name))
 
                 # Are we an actor and is this related to our nodes?
                 if self.object.type == 'ARMATURE' or (
@@ -183,20 +291,18 @@ class Group:
                         self.object.data.shape_keys and
                         len(self.object.data.shape_keys.key_blocks) > 1)
                 ):
-                    egg_str.append('%s<Dart> { 1 }\n' % ('  ' * (level + 1)))
+                    stream.write_line('<Dart> { 1 }')
 
             if self._yabee_object:
-                for line in self._yabee_object.get_full_egg_str().splitlines():
-                    egg_str.append('%s%s\n' % ('  ' * (level + 1), line))
+                self._yabee_object.write_egg(stream)
 
             for child in self.children:
-                egg_str.append(child.get_full_egg_str(level + 1))
+                child.write_egg(stream)
 
-            egg_str.append('%s}\n' % ('  ' * level))
+            stream.close()
         else:
             for child in self.children:
-                egg_str.append(child.get_full_egg_str(level + 1))
-        return egg_str
+                child.write_egg(stream)
 
 
 class EGGArmature(Group):
@@ -205,36 +311,132 @@ class EGGArmature(Group):
     Receives Blender's bones list as obj_list in constructor.
     """
 
-    def get_full_egg_str(self, vrefs, arm_owner, level=0):
+    @staticmethod
+    def get_children_index(obj_list):
         """
-        Create and return string representation of the EGG <Joint> with hierarchy.
+        Map the parent bone names to their children, in the order of obj_list.
+        The key is None for bones, which parent is not in the list.
 
-        @param vrefs: reference of vertices, linked to bones.
-        @param arm_owner: Armature object - owner of the bones
-        @param level: indent level.
+        @param obj_list: tuple or list of blender's bones.
+        @return: dict {key: [children]}.
+        """
+        children_index = {}
+        names = {bone.name for bone in obj_list}
+        for bone in obj_list:
+            key = bone.parent.name if bone.parent and bone.parent.name in names else None
+            children_index.setdefault(key, []).append(bone)
+        return children_index
+
+    def make_hierarchy_from_list(self, obj_list):
+        """
+        Old <Group> function
+        -------------------------------
+        This function make <Group> hierarchy from the list of
+        Blender's objects. Self.object is the top level of the created
+        hierarchy. Usually in this case self.object == None
+
+        @param obj_list: tuple or list of blender's objects.
+        """
+        return self.make_hierarchy_from_index(self.get_children_index(obj_list))
+
+    def make_hierarchy_from_index(self, children_index):
+        """
+        Make the joints hierarchy under self.object from the index,
+        returned by get_children_index().
 
-        @return: the EGG string with joints hierarchy
+        @param children_index: dict {key: [children]}.
         """
-        egg_str = ''
+        for obj in children_index.get(self.object.name if self.object else None, []):
+            try:
+                group = self.__class__(obj)
+            except:
+                print_exc()
+                return ['ERR_MK_OBJ', ]
+            self.children.append(group)
+            group.make_hierarchy_from_index(children_index)
+        return []
 
+    def get_full_egg_str(self, vrefs, arm_owner):
+        return get_egg_str(self.write_egg, vrefs, arm_owner)
+
+    def write_egg(self, stream, vrefs, arm_owner):
+        """
+        Write representation of the EGG <Joint> with hierarchy.
+
+        @param stream: EGGStream to write.
+        @param vrefs: dict {bone name: [reference of vertices]}, see Skeleton.vrefs.
+        @param arm_owner: Armature object - owner of the bones
+        """
         if self.object:
-            egg_str += '%s<Joint> %s {\n' % ('  ' * level, eggSafeName(self.object.yabee_name))
-            vref = {}
-            if self.object.yabee_name in list(vrefs.keys()):
-                vref = vrefs[self.object.yabee_name]
-
-            joint = EGGJointObjectData(self.object, vref, arm_owner)
-            for line in joint.get_full_egg_str().splitlines():
-                egg_str += '%s%s\n' % ('  ' * (level + 1), line)
+            stream.open('<Joint> %s' % eggSafeName(self.object.name))
+            EGGJointObjectData(self.object, vrefs.get(self.object.name, []), arm_owner).write_egg(stream)
             for child in self.children:
-                egg_str += child.get_full_egg_str(vrefs, arm_owner, level + 1)
-            egg_str += '%s}\n' % ('  ' * level)
+                child.write_egg(stream, vrefs, arm_owner)
+            stream.close()
 
         else:
             for child in self.children:
-                egg_str += child.get_full_egg_str(vrefs, arm_owner, level + 1)
+                child.write_egg(stream, vrefs, arm_owner)
+
+
+class Skeleton:
+    """
+    Bones data of the armature, shared by the <Joint> hierarchy, the actors and the
+    animations. It's built once per export by get_skeleton().
+    """
+
+    def __init__(self, arm):
+        """
+        @param arm: Blender's Armature object.
+        """
+        self.armature = arm
+        #: Pose bone names and the parent index of each one (-1 for the root bones)
+        self.names = arm.pose.bones.keys()
+        name_index = {name: idx for idx, name in enumerate(self.names)}
+        self.parents = np.array([name_index[bone.parent.name] if bone.parent else -1
+                                 for bone in arm.pose.bones], dtype = np.int32)
+        #: {parent bone name or None: [child bones]}
+        self.children_index = EGGArmature.get_children_index(arm.data.bones)
+        #: {bone name: bind matrix relative to the parent bone or to the world for the root bones}
+        self.bind_matrices = {}
+        for bone in arm.data.bones:
+            if bone.parent:
+                self.bind_matrices[bone.name] = bone.parent.matrix_local.inverted() @ bone.matrix_local
+            else:
+                self.bind_matrices[bone.name] = arm.matrix_world @ bone.matrix_local
+        #: {bone name: [{vertex pool name: [(EGG vertex index, weight)]}]}, filled by the actors
+        self.vrefs = {}
+
+    def add_vrefs(self, joint_vtx_ref):
+        """
+        Add the vertex references of the actor.
+
+        @param joint_vtx_ref: dict, returned by EGGActorObjectData.pre_convert_joint_vtx_ref().
+        """
+        for name, vref in joint_vtx_ref.items():
+            if name in self.bind_matrices:
+                # Parts of the merged actor add to the same vertex pool
+                pools = self.vrefs.setdefault(name, [{}])[0]
+                for vpool, data in vref.items():
+                    pools.setdefault(vpool, []).extend(data)
+
+    def get_children_index(self, bone_names):
+        """
+        @param bone_names: names of the bones with all their parents.
+        @return: children_index, which contains only the given bones.
+        """
+        return {parent: [bone for bone in bones if bone.name in bone_names]
+                for parent, bones in self.children_index.items() if parent is None or parent in bone_names}
 
-        return egg_str
+
+def get_skeleton(arm):
+    """
+    @param arm: Blender's Armature object.
+    @return: the cached Skeleton of the armature.
+    """
+    if arm.name not in SKELETONS:
+        SKELETONS[arm.name] = Skeleton(arm)
+    return SKELETONS[arm.name]
 
 
 # -----------------------------------------------------------------------
@@ -247,27 +449,30 @@ class EGGBaseObjectData:
 
     def __init__(self, obj):
         self.obj_ref = obj
-        if obj.parent:
+        parent = get_export_parent(obj)
+        if parent and parent != obj.parent:
+            self.transform_matrix = parent.matrix_world.inverted() @ obj.matrix_world
+        elif parent:
             self.transform_matrix = obj.matrix_local
         else:
             self.transform_matrix = obj.matrix_world
 
-    def get_transform_str(self):
+    def write_transform(self, stream):
         """
-        Return the EGG string representation of object transforms.
+        Write the EGG representation of object transforms.
         """
-        transform_str = ['<Transform> {\n  <Matrix4> {\n', ]
-        for column in self.transform_matrix.col:
-            transform_str.append('    ')
-            for row in column[:]:
-                # transform_str += [STRF( row ), ' ']
-                transform_str += [str(row), ' ']
-            transform_str.append('\n')
-        transform_str.append('  }\n}\n')
-        return ''.join(transform_str)
+        stream.open('<Transform>')
+        stream.open('<Matrix4>')
+        for column_str in STRF.rows(np.array(self.transform_matrix).T):
+            stream.write_line(column_str)
+        stream.close()
+        stream.close()
+
+    def write_egg(self, stream):
+        self.write_transform(stream)
 
     def get_full_egg_str(self):
-        return self.get_transform_str() + '\n'
+        return get_egg_str(self.write_egg)
 
 
 class EGGNurbsCurveObjectData(EGGBaseObjectData):
@@ -276,38 +481,31 @@ class EGGNurbsCurveObjectData(EGGBaseObjectData):
     """
 
     def collect_vertices(self):
-        vertices = []
-        idx = 0
         for spline in self.obj_ref.data.splines:
             for vtx in spline.points:
-                co = self.obj_ref.matrix_world * vtx.co
-                fixed_co = tuple(map(lambda x: x * co[3], co[:3])) + (co[3],)
-                vertices.append('<Vertex> %i {\n  %s\n}\n' % (idx, ' '.join(map(STRF, fixed_co))))
-                idx += 1
-        return vertices
+                co = self.obj_ref.matrix_world @ vtx.co
+                yield tuple(map(lambda x: x * co[3], co[:3])) + (co[3],)
 
-    def get_vtx_pool_str(self):
+    def write_vtx_pool(self, stream):
         """
-        Return the vertex pool string in the EGG syntax.
+        Write the vertex pool in the EGG syntax.
         """
-        vtx_pool = ''
-        vertices = self.collect_vertices()
+        vertices = list(self.collect_vertices())
         if vertices:
-            vtx_pool = '<VertexPool> %s {\n' % eggSafeName(self.obj_ref.yabee_name)
-            for vtx_str in vertices:
-                for line in vtx_str.splitlines():
-                    vtx_pool += '  ' + line + '\n'
-            vtx_pool += '}\n'
-        return vtx_pool
+            stream.open('<VertexPool> %s' % eggSafeName(self.obj_ref.name))
+            for idx, co in enumerate(vertices):
+                stream.open('<Vertex> %i' % idx)
+                stream.write_line(STRF.join(co))
+                stream.close()
+            stream.close()
 
-    def get_curves_str(self):
+    def write_curves(self, stream):
         """
-        Return the <NURBSCurve> string.
+        Write the <NURBSCurve> entries.
         Blender 2.5 has not contain Knots information, seems it's calculating in runtime.
         I got algorythm for the knots calculation from the OBJ exporter and modified it.
         """
         str2f = lambda x: '%.2f' % x
-        cur_str = ''
         idx = 0
         for spline in self.obj_ref.data.splines:
             if spline.type != "NURBS":
@@ -320,20 +518,21 @@ class EGGNurbsCurveObjectData(EGGBaseObjectData):
                     knots[-(i + 1)] = 1.0
                 for i in range(knots_num - (spline.order_u * 2) + 2):
                     knots[i + spline.order_u - 1] = i / (knots_num - (spline.order_u * 2) + 1)
-            cur_str += '<NURBSCurve> {\n'
-            cur_str += '  <Scalar> subdiv { %i }\n' % (spline.resolution_u * (spline.point_count_u - 1))
-            cur_str += '  <Order> { %i }\n' % spline.order_u
-            cur_str += '  <Knots> { %s }\n' % ' '.join(map(str2f, knots))
-            cur_str += '  <VertexRef> {\n    %s\n    <Ref> { %s } \n  }\n' % (
-                ' '.join([str(i) for i in range(idx, idx + spline.point_count_u)]),
-                eggSafeName(self.obj_ref.yabee_name)
-            )
-            cur_str += '}\n'
+            stream.open('<NURBSCurve>')
+            stream.write_line('<Scalar> subdiv { %i }' % (spline.resolution_u * (spline.point_count_u - 1)))
+            stream.write_line('<Order> { %i }' % spline.order_u)
+            stream.write_line('<Knots> { %s }' % ' '.join(map(str2f, knots)))
+            stream.open('<VertexRef>')
+            stream.write_line(' '.join([str(i) for i in range(idx, idx + spline.point_count_u)]))
+            stream.write_line('<Ref> { %s }' % eggSafeName(self.obj_ref.name))
+            stream.close()
+            stream.close()
             idx += spline.point_count_u
-        return cur_str
 
-    def get_full_egg_str(self):
-        return self.get_transform_str() + self.get_vtx_pool_str() + self.get_curves_str()
+    def write_egg(self, stream):
+        self.write_transform(stream)
+        self.write_vtx_pool(stream)
+        self.write_curves(stream)
 
 
 class EGGJointObjectData(EGGBaseObjectData):
@@ -348,39 +547,28 @@ class EGGJointObjectData(EGGBaseObjectData):
         """
         self.obj_ref = obj
         self.arm_owner = arm_owner
-        if not obj.parent:
-            # Get the current transformation matrix by (world space * local space)
-            self.transform_matrix = arm_owner.matrix_world @ obj.matrix_local
-        else:
-            # I think this just negates some world transformation idk
-            self.transform_matrix = obj.parent.matrix_local.inverted() @ obj.matrix_local
+        self.transform_matrix = get_skeleton(arm_owner).bind_matrices[obj.name]
         self.vref = vref
 
-    def get_vref_str(self):
+    def write_vref(self, stream):
         """
-        Convert vertex reference to the EGG string and return it.
+        Convert vertex reference to the EGG <VertexRef> entries.
         """
-        vref_str = ''
         for meshes in self.vref:
             for vpool, data in meshes.items():
                 weightgroups = {}
                 for idx, weight in data:
-                    weight_str = '%f' % weight
-                    if weight_str not in list(weightgroups.keys()):
-                        weightgroups[weight_str] = []
-                    weightgroups[weight_str].append(idx)
+                    weightgroups.setdefault(STRF(weight), []).append(idx)
                 for wgrp, idxs in weightgroups.items():
-                    vref_str += '<VertexRef> {\n'
-                    vref_str += '  ' + ' '.join(map(str, idxs)) + '\n'
-                    vref_str += '  <Scalar> membership { %s }' % wgrp
-                    vref_str += '  <Ref> { %s }\n}\n' % vpool
-        return vref_str
+                    stream.open('<VertexRef>')
+                    stream.write_line(' '.join(map(str, idxs)))
+                    stream.write_line('<Scalar> membership { %s }' % wgrp)
+                    stream.write_line('<Ref> { %s }' % vpool)
+                    stream.close()
 
-    def get_full_egg_str(self):
-        egg_str = ''
-        egg_str += self.get_transform_str()
-        egg_str += self.get_vref_str()
-        return egg_str
+    def write_egg(self, stream):
+        self.write_transform(stream)
+        self.write_vref(stream)
 
 
 # -----------------------------------------------------------------------
@@ -393,112 +581,270 @@ class EGGMeshObjectData(EGGBaseObjectData):
 
     def __init__(self, obj):
         EGGBaseObjectData.__init__(self, obj)
-        self.poly_vtx_ref = self.pre_convert_poly_vtx_ref()
-        self.smooth_vtx_list = self.get_smooth_vtx_list()
+        # Evaluated copy of the mesh, if write_out has made one for the object.
+        self.mesh = EXPORT_MESHES.get(obj.name, obj.data)
+        # Vertex pool, which the vertices are written to, and the index of the first vertex in it
+        self.vpool_name = obj.name
+        self.vtx_offset = 0
+        self.extract_mesh_arrays()
+        self.pre_convert_world_space()
+        self.smooth_vtx_mask = self.get_smooth_vtx_mask()
         self.colors_vtx_ref = self.pre_convert_vtx_color()
+        self.rgba_vtx_mask = self.get_rgba_vtx_mask()
         self.uvs_list = self.pre_convert_uvs()
+        self.default_rgba = self.get_default_rgba()
         self.tangent_layers = None
         if CALC_TBS == 'BLENDER':
             self.tangent_layers = self.pre_calc_TBS()
+        self.build_vertex_pool()
+        self.merged_parts = self.join_vertex_pool()
+        self.poly_vtx_ref = self.pre_convert_poly_vtx_ref()
 
         # Check if we may need to generate ORCO coordinates.
         uses_nodes = False
         need_orco = False
-        for face in self.obj_ref.data.polygons:
-            if face.material_index >= len(obj.data.materials):
+        for mat_idx in np.unique(self.poly_material):
+            if mat_idx >= len(self.materials):
                 continue
-            if not obj.data.materials[face.material_index]:
+            if not self.materials[mat_idx]:
                 continue
-            if obj.data.materials[face.material_index]:
-                if obj.data.materials[face.material_index].use_nodes:
-                    uses_nodes = True
+            if self.materials[mat_idx].use_nodes:
+                uses_nodes = True
 
         # Store current active UV name
         self.active_uv = None
 
         # now there is no uv_layers attribute, instead uv_layers
-        auv = [uv for uv in obj.data.uv_layers if uv.active]
+        auv = [uv for uv in self.mesh.uv_layers if uv.active]
 
         # if we use nodes we don't want the active-uv name to be empty later on.
         # (we need those to access from uv-map nodes)
         if not uses_nodes and auv:
             self.active_uv = auv[0].name
 
+    # -------------------------------------------------------------------
+    #                           EXTRACTION
+
+    def extract_mesh_arrays(self):
+        """
+        Pull the mesh data into the flat NumPy arrays with foreach_get. Everything else
+        reads the vertices from these arrays instead of the per-element RNA access.
+
+        The EGG vertex index is the running index of the polygon corners (loops), taken
+        polygon by polygon. loop_order maps it to the Blender's loop index, all the per-loop
+        arrays are already sorted in the EGG order.
+        """
+        mesh = self.mesh
+        self.materials = list(mesh.materials)
+
+        self.vtx_co = foreach_get_array(mesh.vertices, 'co', width = 3)
+        self.vtx_normal = foreach_get_array(mesh.vertices, 'normal', width = 3)
+
+        poly_loop_start = foreach_get_array(mesh.polygons, 'loop_start', np.int32)
+        self.poly_loop_total = foreach_get_array(mesh.polygons, 'loop_total', np.int32)
+        self.poly_material = foreach_get_array(mesh.polygons, 'material_index', np.int32)
+        self.poly_normal = foreach_get_array(mesh.polygons, 'normal', width = 3)
+        self.poly_smooth = foreach_get_array(mesh.polygons, 'use_smooth', bool)
+        self.poly_vtx_offset = np.cumsum(self.poly_loop_total) - self.poly_loop_total
+
+        loops_num = int(self.poly_loop_total.sum())
+        self.loop_order = np.repeat(poly_loop_start - self.poly_vtx_offset, self.poly_loop_total) + \
+                          np.arange(loops_num)
+        self.loop_poly = np.repeat(np.arange(len(self.poly_loop_total)), self.poly_loop_total)
+        self.loop_vtx = foreach_get_array(mesh.loops, 'vertex_index', np.int32)[self.loop_order]
+
+        self.loop_uvs = []
+        for uv_layer in mesh.uv_layers:
+            uvs = foreach_get_array(uv_layer.data, 'uv', width = 2)
+            self.loop_uvs.append((uv_layer.name, uvs[self.loop_order]))
+
+        self.loop_color = None
+        if mesh.vertex_colors.active:
+            colors = foreach_get_array(mesh.vertex_colors.active.data, 'color', width = 4)
+            self.loop_color = colors[self.loop_order]
+
+        self.loop_normal = None
+        if USE_LOOP_NORMALS and mesh.has_custom_normals:
+            if hasattr(mesh, 'calc_normals_split'):
+                # Blender 4.1+ keeps the corner normals up to date by itself
+                mesh.calc_normals_split()
+            self.loop_normal = foreach_get_array(mesh.loops, 'normal', width = 3)[self.loop_order]
+
+        self.shape_key_co = []
+        if mesh.shape_keys and len(mesh.shape_keys.key_blocks) > 1:
+            for key in mesh.shape_keys.key_blocks[1:]:
+                self.shape_key_co.append((key.name, foreach_get_array(key.data, 'co', width = 3)))
+
+    def pre_convert_world_space(self):
+        """
+        EGG stores the vertices in the world space. Transform positions, normals and morph
+        deltas of the whole mesh at once. Normals use the inverse-transpose of the world matrix,
+        calculated once for the object.
+        """
+        matrix = self.get_space_matrix()
+        normal_matrix = get_normal_matrix(matrix)
+        linear = np.array(matrix, dtype = np.float64)[:3, :3]
+
+        self.world_co = transform_points(matrix, self.vtx_co)
+        self.world_vtx_normal = transform_normals(normal_matrix, self.vtx_normal)
+        self.world_poly_normal = transform_normals(normal_matrix, self.poly_normal)
+        self.world_loop_normal = None
+        if self.loop_normal is not None:
+            self.world_loop_normal = transform_normals(normal_matrix, self.loop_normal)
+
+        # Morph deltas are directions, so they get the linear part of the transform only
+        self.world_shape_deltas = []
+        for name, key_co in self.shape_key_co:
+            deltas = (key_co - self.vtx_co) @ linear.T
+            self.world_shape_deltas.append((name, deltas, np.linalg.norm(deltas, axis = 1) > 0.000001))
+
+    def get_space_matrix(self):
+        """
+        @return: matrix, which transforms the mesh into the space of the EGG vertices.
+        """
+        return self.obj_ref.matrix_world
+
     # -------------------------------------------------------------------
     #                           AUXILIARY
 
-    def get_smooth_vtx_list(self):
+    def get_smooth_vtx_mask(self):
         """
-        Collect the smoothed polygon vertices for write normals of the vertices.
+        Mark the smoothed polygon vertices for write normals of the vertices.
         In the EGG for the smooth shading used normals of vertices. For solid - polygons.
+
+        @return: boolean array, indexed by the EGG vertex index.
+        """
+        vtx_mask = np.repeat(self.poly_smooth, self.poly_loop_total)
+
+        mesh = self.mesh
+        if hasattr(mesh, "use_auto_smooth") and mesh.use_auto_smooth:
+            # Every polygon corner lies on two polygon edges: the edge going out of the corner
+            # and the edge coming into it. The corner is sharp if any of them is sharp.
+            edge_sharp = foreach_get_array(mesh.edges, 'use_edge_sharp', bool)
+            loop_edge = foreach_get_array(mesh.loops, 'edge_index', np.int32)[self.loop_order]
+            prev_loop = np.arange(len(loop_edge)) - 1
+            prev_loop[self.poly_vtx_offset] = self.poly_vtx_offset + self.poly_loop_total - 1
+            vtx_mask &= ~(edge_sharp[loop_edge] | edge_sharp[loop_edge[prev_loop]])
+        return vtx_mask
+
+    def get_rgba_vtx_mask(self):
+        """
+        Mark the polygon corners, which get the vertex color. Don't write out vertex colors
+        unless a material actually uses it, but write them out if no material applied.
+
+        @return: boolean array, indexed by the EGG polygon corner index.
         """
-        vtx_list = []
-        for poly_index, polygon in enumerate(self.obj_ref.data.polygons):
-            if polygon.use_smooth:
-                for vertex in self.poly_vtx_ref[poly_index]:
-                    vtx_list.append(vertex)
-        vtx_list = set(vtx_list)
-
-        if hasattr(self.obj_ref.data, "use_auto_smooth") and self.obj_ref.data.use_auto_smooth:
-            sharp_edges = [edge.key for edge in self.obj_ref.data.edges if edge.use_edge_sharp]
-            for poly_index, polygon in enumerate(self.obj_ref.data.polygons):
-                for poly_edge in polygon.edge_keys:
-                    if poly_edge in sharp_edges:
-                        for edge_vertex in poly_edge:
-                            edge_index = list(polygon.vertices).index(edge_vertex)
-                            iv = self.poly_vtx_ref[poly_index][edge_index]
-                            if iv in vtx_list:
-                                vtx_list.remove(iv)
-        return vtx_list
+        mat_flags = np.array([FORCE_EXPORT_VERTEX_COLORS or bool(mat) for mat in self.materials] + [True])
+        return mat_flags[np.minimum(self.poly_material[self.loop_poly], len(self.materials))]
+
+    def get_default_rgba(self):
+        """
+        Collect the <RGBA> attributes, which are written for every vertex when the mesh has no vertex colors.
+        """
+        attributes = []
+        if self.loop_color is None:
+            # if material has no texture:
+            for mat in self.materials:
+                nodeTree = mat and mat.node_tree
+                if nodeTree and nodeTree.nodes:
+                    for pandaShaderNode in nodeTree.links:
+                        if pandaShaderNode.to_node.name == "Material Output":
+                            attributes.append('<RGBA> { 1 1 1 1 }')
+        return attributes
 
     def pre_convert_uvs(self):
         """
         Blender uses shared vertices, but for the correct working UV and shading in the Panda needs to convert
         they are in the individual vertices for each polygon.
         """
-        uv_list = []
-        for uv_layer in self.obj_ref.data.uv_layers:
-            data = []
-            for uv_data in uv_layer.data:
-                u, v = uv_data.uv.to_2d()
-                data.append((u, v))
-            uv_list.append((uv_layer.name, data))
-        return uv_list
+        return list(self.loop_uvs)
 
-    def pre_convert_poly_vtx_ref(self):
+    def get_weld_keys(self):
+        """
+        Collect per-corner arrays of everything written into the <Vertex>.
+        Corners with the same values in all of them can share a single EGG vertex.
+
+        @return: list of 2D arrays, each has a row per EGG polygon corner.
         """
+        keys = [self.world_co[self.loop_vtx]]
+
+        if self.world_loop_normal is not None:
+            normals = self.world_loop_normal
+        else:
+            normals = self.world_vtx_normal[self.loop_vtx]
+        keys.append(self.smooth_vtx_mask[:, None])
+        keys.append(normals * self.smooth_vtx_mask[:, None])
+
+        if self.colors_vtx_ref is not None:
+            keys.append(self.rgba_vtx_mask[:, None])
+            keys.append(self.colors_vtx_ref * self.rgba_vtx_mask[:, None])
+
+        for name, data in self.uvs_list:
+            keys.append(data)
+        for tangents in self.tangent_layers or []:
+            keys.append(tangents)
+        for name, deltas, moved in self.world_shape_deltas:
+            keys.append((deltas * moved[:, None])[self.loop_vtx])
+        return keys
+
+    def build_vertex_pool(self):
+        """
+        Make the EGG vertex pool from the polygon corners.
+
         Blender uses shared vertices, but for the correct working UV and shading in the Panda
-        needs to convert they are in the individual vertices for each polygon.
+        needs to convert they are in the individual vertices for each polygon. With WELD_VERTICES
+        the corners with identical attributes (see get_weld_keys) are merged back into one vertex.
+        Duplicates are found by sorting the attribute rows, so it stays O(n log n).
+
+        Sets pool_loops (the EGG vertex index -> the polygon corner, which represents it) and
+        loop_pool (the polygon corner -> the EGG vertex index).
         """
-        poly_vtx_ref = []
-        idx = 0
-        for face in self.obj_ref.data.polygons:
-            vtxs = []
-            for vertex in face.vertices:
-                vtxs.append(idx)
-                idx += 1
-            poly_vtx_ref.append(vtxs)
-        return poly_vtx_ref
+        loops_num = len(self.loop_vtx)
+        self.pool_loops = np.arange(loops_num)
+        self.loop_pool = np.arange(loops_num)
+        if not WELD_VERTICES or not loops_num:
+            return
+
+        keys = np.hstack([np.asarray(key, dtype = np.float64) for key in self.get_weld_keys()])
+        _, first, inverse = np.unique(keys, axis = 0, return_index = True, return_inverse = True)
+        # Keep the vertices in order of the first use by polygons
+        order = np.argsort(first)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        self.pool_loops = first[order]
+        self.loop_pool = rank[inverse.ravel()]
+        print('INFO: Welded %s: %i -> %i vertices' % (self.obj_ref.name, loops_num, len(self.pool_loops)))
+
+    def join_vertex_pool(self):
+        """
+        Choose the vertex pool for the vertices: sets vpool_name and vtx_offset, which
+        the polygons and the joints refer to. Plain meshes keep their own pool.
+
+        @return: list of the meshes, which vertices and polygons this mesh writes.
+        """
+        return [self]
+
+    def pre_convert_poly_vtx_ref(self):
+        """
+        Collect the EGG vertex indices of each polygon.
+        """
+        return [vref.tolist() for vref in np.split(self.loop_pool + self.vtx_offset, self.poly_vtx_offset[1:])]
 
     def pre_convert_vtx_color(self):
-        color_vtx_ref = []
-        if self.obj_ref.data.vertex_colors.active:
-            for col in self.obj_ref.data.vertex_colors.active.data:
-                color_vtx_ref.append(col.color)  # We have one color per data color
-        return color_vtx_ref
+        # We have one color per polygon corner
+        return self.loop_color
 
     def pre_calc_TBS(self):
         """
         Use Blender internal algorithm to generate tangent and bitangent (binormal) for each UV layer
         """
         tangent_layers = []
-        for idx, uv_layer in enumerate(self.obj_ref.data.uv_layers):
-            tangents = []
-            self.obj_ref.data.calc_tangents(uvmap = uv_layer.name)
-
-            for loop in self.obj_ref.data.loops:
-                tangents.append(loop.tangent[:] + loop.bitangent[:])
-            tangent_layers.append(tangents)
+        mesh = self.mesh
+        for idx, uv_layer in enumerate(mesh.uv_layers):
+            mesh.calc_tangents(uvmap = uv_layer.name)
+            tangents = np.hstack((foreach_get_array(mesh.loops, 'tangent', width = 3),
+                                  foreach_get_array(mesh.loops, 'bitangent', width = 3)))
+            tangent_layers.append(tangents[self.loop_order])
         return tangent_layers
 
     def pre_calc_ORCO(self):
@@ -509,196 +855,146 @@ class EGGMeshObjectData(EGGBaseObjectData):
         Basically, given the local bounding box of the object: Orco(v) = 2*(v-center)/size.
         """
         print("precalculating orco")
-        # To get a bounding box, we first have to calculate the min and max vertex position...
-        minmax = None
-        for face in self.obj_ref.data.polygons:
-            for vertex in face.vertices:
-                pos = self.obj_ref.data.vertices[vertex].co
-                if minmax is None:
-                    minmax = (list(pos), list(pos))
-                for i in range(3):
-                    minmax[0][i] = min(pos[i], minmax[0][i])
-                    minmax[1][i] = max(pos[i], minmax[1][i])
-
-        if not minmax:
+        if not len(self.loop_vtx):
             return
 
-        # uvw?
-        inv_dims = [0, 0, 0]
-        for i in (0, 1, 2):
-            delta = (minmax[1][i] - minmax[0][i])
-            if delta > 0:  # Prevent divide by zero
-                inv_dims[i] = 1.0 / delta
-
-        data = []
-        for face in self.obj_ref.data.polygons:
-            for vertex in face.vertices:
-                pos = self.obj_ref.data.vertices[vertex].co
-                orco = [(pos[i] - minmax[0][i]) * inv_dims[i] for i in (0, 1, 2)]
-                data.append(orco)
+        # To get a bounding box, we first have to calculate the min and max vertex position...
+        pos = self.vtx_co[self.loop_vtx]
+        min_co = pos.min(axis = 0)
+        delta = pos.max(axis = 0) - min_co
 
-        self.uvs_list.append(('ORCO', data))
+        # uvw?
+        # Prevent divide by zero
+        inv_dims = np.divide(1.0, delta, out = np.zeros_like(delta), where = delta > 0)
+        self.uvs_list.append(('ORCO', (pos - min_co) * inv_dims))
 
     # -------------------------------------------------------------------
     #                           VERTICES
 
-    def collect_vtx_xyz(self, vidx, attributes):
+    def get_masked_column(self, template, values, mask):
         """
-        Add coordinates of the vertex to the vertex attributes list
+        Format the attribute for the vertices, which have it.
 
-        @param vidx: Blender's internal vertex index.
-        @param attributes: list of vertex attributes
+        @param template: attribute string template with the single %s for values.
+        @param values: (N, M) array of the attribute values.
+        @param mask: boolean array, True for the vertices, which have this attribute.
 
-        @return: list of vertex attributes.
+        @return: list of N strings, empty for the vertices without the attribute.
         """
-        # get coords relative to itself?
-        co = self.obj_ref.matrix_world @ self.obj_ref.data.vertices[vidx].co
-        attributes.append('%f %f %f' % co[:])
-        return attributes
+        column = [''] * len(mask)
+        indices = np.flatnonzero(mask)
+        for i, value_str in zip(indices.tolist(), STRF.rows(values[indices])):
+            column[i] = template % value_str
+        return column
 
-    def collect_vtx_dxyz(self, vidx, attributes):
+    def collect_vtx_xyz(self, loops, vtxs):
         """
-        Add morph target <Dxyz> to the vertex attributes list.
+        Format coordinates of the vertices.
 
-        @param vidx: Blender's internal vertex index.
-        @param attributes: list of vertex attributes
+        @param loops: the EGG polygon corner indices, which represent the vertices.
+        @param vtxs: Blender's internal vertex indices.
 
-        @return: list of vertex attributes.
+        @return: list of attribute columns, each has a string per vertex.
         """
-        if self.obj_ref.data.shape_keys and (len(self.obj_ref.data.shape_keys.key_blocks) > 1):
-            for i in range(1, len(self.obj_ref.data.shape_keys.key_blocks)):
-                key = self.obj_ref.data.shape_keys.key_blocks[i]
-                vtx = self.obj_ref.data.vertices[vidx]
-                co = key.data[vidx].co @ self.obj_ref.matrix_world - vtx.co @ self.obj_ref.matrix_world
-                if co.length > 0.000001:
-                    attributes.append('<Dxyz> %s { %f %f %f }\n' % (eggSafeName(key.name), co[0], co[1], co[2]))
-        return attributes
+        return [STRF.rows(self.world_co[vtxs])]
 
-    def collect_vtx_normal(self, v, idx, attributes):
+    def collect_vtx_dxyz(self, loops, vtxs):
         """
-        Add <Normal> to the vertex attributes list.
+        Format morph target <Dxyz> of the vertices.
 
-        @param v: Blender vertex index.
-        @param idx: the EGG (converted) vertex index.
-        @param attributes: list of vertex attributes
+        @param loops: the EGG polygon corner indices, which represent the vertices.
+        @param vtxs: Blender's internal vertex indices.
 
-        @return: list of vertex attributes.
+        @return: list of attribute columns, each has a string per vertex.
         """
-        if idx in self.smooth_vtx_list:
-            no = self.obj_ref.matrix_world.to_euler().to_matrix() @ self.obj_ref.data.vertices[v].normal
-            # no = self.obj_ref.data.vertices[v].normal
-            # no = self.obj_ref.data.loops[idx].normal
-            attributes.append('<Normal> { %f %f %f }' % no[:])
+        columns = []
+        for name, deltas, moved in self.world_shape_deltas:
+            template = '<Dxyz> %s { %%s }' % eggSafeName(name).replace('%', '%%')
+            columns.append(self.get_masked_column(template, deltas[vtxs], moved[vtxs]))
+        return columns
 
-        return attributes
-
-    def collect_vtx_normal_from_loop(self, v, idx, attributes):
+    def collect_vtx_normal(self, loops, vtxs):
         """
-        Add <Normal> to the vertex attributes list, using the loop normal associated with this Blender vertex index.
+        Format <Normal> of the vertices. Only smoothed vertices have it, flat ones use the polygon normal.
+        Custom loop normals (if exist) replace the vertex normals.
 
-        @param v: Blender vertex index.
-        @param idx: the EGG (converted) vertex index.
-        @param attributes: list of vertex attributes
+        @param loops: the EGG polygon corner indices, which represent the vertices.
+        @param vtxs: Blender's internal vertex indices.
 
-        @return: list of vertex attributes.
+        @return: list of attribute columns, each has a string per vertex.
         """
-        if idx in self.smooth_vtx_list:
-            no = self.obj_ref.matrix_world.to_euler().to_matrix() @ self.obj_ref.data.loops[
-                self.map_vertex_to_loop[v]].normal
-            attributes.append('  <Normal> { %f %f %f }' % no[:])
-        return attributes
-
-    def collect_vtx_rgba(self, vidx, face, attributes):
-        if self.colors_vtx_ref:
-            # Don't write out vertex colors unless a material actually uses it.
-            if face.material_index < len(self.obj_ref.data.materials):
-                mat = self.obj_ref.data.materials[face.material_index]
-                if FORCE_EXPORT_VERTEX_COLORS or mat:
-                    vcolors = self.colors_vtx_ref[vidx]
-                    attributes.append('  <RGBA> { %f %f %f %f }' % vcolors[:])
-            else:
-                # Write out vertex colors if no material applied
-                vcolors = self.colors_vtx_ref[vidx]
-                attributes.append('  <RGBA> { %f %f %f %f }' % vcolors[:])
+        if self.world_loop_normal is not None:
+            normals = self.world_loop_normal[loops]
         else:
-            # if material has no texture:
-            for mat in self.obj_ref.data.materials:
-                nodeTree = mat.node_tree
-                if nodeTree and nodeTree.nodes:
-                    for pandaShaderNode in nodeTree.links:
-                        if pandaShaderNode.to_node.name == "Material Output":
-                            attributes.append('  <RGBA> { 1 1 1 1 }')
-        return attributes
+            normals = self.world_vtx_normal[vtxs]
+        return [self.get_masked_column('<Normal> { %s }', normals, self.smooth_vtx_mask[loops])]
+
+    def collect_vtx_rgba(self, loops, vtxs):
+        """
+        Format <RGBA> of the vertices.
+
+        @param loops: the EGG polygon corner indices, which represent the vertices.
+        @param vtxs: Blender's internal vertex indices.
+
+        @return: list of attribute columns, each has a string per vertex.
+        """
+        if self.colors_vtx_ref is not None:
+            return [self.get_masked_column('<RGBA> { %s }', self.colors_vtx_ref[loops], self.rgba_vtx_mask[loops])]
+        return [[rgba] * len(loops) for rgba in self.default_rgba]
 
-    def collect_vtx_uv(self, vidx, ividx, attributes):
+    def collect_vtx_uv(self, loops, vtxs):
         """
-        Add <UV> to the vertex attributes list.
+        Format <UV> (and <Tangent>, <Binormal> if calculated) of the vertices.
 
-        @param vidx: the EGG (converted) vertex index.
-        @param ividx: Blender internal vertex index.
-        @param attributes: list of vertex attributes
+        @param loops: the EGG polygon corner indices, which represent the vertices.
+        @param vtxs: Blender's internal vertex indices.
 
-        @return: list of vertex attributes.
+        @return: list of attribute columns, each has a string per vertex.
         """
+        columns = []
         for i, uv in enumerate(self.uvs_list):
             name, data = uv
             if name == self.active_uv and name != 'ORCO':
                 name = ''
-            tbs = ''
+            uv_strs = STRF.rows(data[loops])
+            header = '<UV> %s {\n  ' % eggSafeName(name)
             if self.tangent_layers:
-                tbs = '\n    <Tangent> {%f %f %f}\n    <Binormal> {%f %f %f}' % self.tangent_layers[i][ividx]
-
-            uv_str = '  <UV> %s {\n    %f %f %s\n  }' % (
-                eggSafeName(name), data[ividx][0], data[ividx][1], tbs
-            )
-            attributes.append(uv_str)
-
-        return attributes
+                tangents = self.tangent_layers[i][loops]
+                columns.append([
+                    '%s%s\n  <Tangent> { %s }\n  <Binormal> { %s }\n}' % (header, uv_str, t_str, b_str)
+                    for uv_str, t_str, b_str in zip(uv_strs, STRF.rows(tangents[:, :3]), STRF.rows(tangents[:, 3:]))
+                ])
+            else:
+                columns.append(['%s%s\n}' % (header, uv_str) for uv_str in uv_strs])
+        return columns
 
     def collect_vertices(self):
         """
-        Convert and collect vertices' info.
+        Convert vertices' info. Attributes are formatted for a batch of vertices at once,
+        then yielded as the EGG vertex index and the list of its attributes, one vertex at a time.
         """
-        xyz = self.collect_vtx_xyz
-        dxyz = self.collect_vtx_dxyz
-        rgba = self.collect_vtx_rgba
-        uv = self.collect_vtx_uv
+        collectors = (self.collect_vtx_xyz, self.collect_vtx_dxyz, self.collect_vtx_normal,
+                      self.collect_vtx_rgba, self.collect_vtx_uv)
 
-        if USE_LOOP_NORMALS and self.obj_ref.data.has_custom_normals:
-            self.map_vertex_to_loop = {
-                self.obj_ref.data.loops[loop_idx].vertex_index: loop_idx
-                for face in self.obj_ref.data.polygons for loop_idx in face.loop_indices
-            }
-            normal = self.collect_vtx_normal_from_loop
-        else:
-            normal = self.collect_vtx_normal
-
-        vertices = []
-        idx = 0
-        for face in self.obj_ref.data.polygons:
-            for vertex in face.vertices:
-                # vertex - Blender inner vertex index
-                # idx - Vertex index for the EGG
-                attributes = []
-                xyz(vertex, attributes)
-                dxyz(vertex, attributes)
-                normal(vertex, idx, attributes)
-                rgba(idx, face, attributes)
-                uv(vertex, idx, attributes)
-                str_attr = '\n'.join(attributes)
-                vtx = '\n<Vertex> %i {%s\n}' % (idx, str_attr)
-                vertices.append(vtx)
-                idx += 1
-        return vertices
+        for start in range(0, len(self.pool_loops), BATCH_SIZE):
+            # loops - EGG polygon corners, which represent the vertices
+            # vtxs - Blender inner vertex indices
+            loops = self.pool_loops[start:start + BATCH_SIZE]
+            vtxs = self.loop_vtx[loops]
+            columns = []
+            for collector in collectors:
+                columns.extend(collector(loops, vtxs))
+            for idx, attributes in enumerate(zip(*columns), start):
+                yield idx, [attribute for attribute in attributes if attribute]
 
     # -------------------------------------------------------------------
     #                           POLYGONS
 
-    def collect_poly_tref(self, face, attributes):
+    def collect_poly_tref(self, mat_idx, attributes):
         """
         Add <TRef> to the polygon's attributes list.
 
-        @param face: face index.
+        @param mat_idx: material index of the polygon.
         @param attributes: list of polygon's attributes.
 
         @return: list of polygon's attributes.
@@ -713,8 +1009,8 @@ class EGGMeshObjectData(EGGBaseObjectData):
             # First, check if that polygon has a material at all
             material = None
             matIsFancyPBRNode = False
-            if face.material_index < len(self.obj_ref.data.materials):
-                material = self.obj_ref.data.materials[face.material_index]
+            if mat_idx < len(self.materials):
+                material = self.materials[mat_idx]
 
             if material:
                 if material.use_nodes:
@@ -757,128 +1053,170 @@ class EGGMeshObjectData(EGGBaseObjectData):
                             attributes.append('<TRef> { %s }' % eggSafeName(tex_name))
 
                 else:
-                    if self.obj_ref.data.uv_layers and material.use_nodes:
+                    if self.mesh.uv_layers and material.use_nodes:
                         for btype, params in BAKE_LAYERS.items():
                             if len(params) == 2:
                                 params = (params[0], params[0], params[1])
                             if params[2]:
-                                attributes.append('<TRef> { %s }' % eggSafeName(self.obj_ref.yabee_name + '_' + btype))
+                                attributes.append('<TRef> { %s }' % eggSafeName(self.obj_ref.name + '_' + btype))
 
         return attributes
 
-    def collect_poly_mref(self, face, attributes):
+    def collect_poly_mref(self, mat_idx, attributes):
         """
         Add <MRef> to the polygon's attributes list.
 
-        @param face: face index.
+        @param mat_idx: material index of the polygon.
         @param attributes: list of polygon's attributes.
 
         @return: list of polygon's attributes.
         """
-        if face.material_index < len(self.obj_ref.data.materials):
-            mat = self.obj_ref.data.materials[face.material_index]
+        if mat_idx < len(self.materials):
+            mat = self.materials[mat_idx]
             if mat:
-                attributes.append('<MRef> { %s }' % eggSafeName(mat.yabee_name))
+                attributes.append('<MRef> { %s }' % eggSafeName(mat.name))
         return attributes
 
-    def collect_poly_normal(self, face, attributes):
+    def collect_poly_normal(self, polys):
         """
-        Add <Normal> to the polygon's attributes list.
+        Format <Normal> of the polygons.
 
-        @param face: face index.
-        @param attributes: list of polygon's attributes.
+        @param polys: polygon indices.
 
-        @return: list of polygon's attributes.
+        @return: list of strings, one per polygon.
         """
         # normalized normal
-        no = self.obj_ref.matrix_world.to_euler().to_matrix() @ face.normal
-        attributes.append('<Normal> {%f %f %f}' % no[:])
-        return attributes
+        return ['<Normal> { %s }' % no_str for no_str in STRF.rows(self.world_poly_normal[polys])]
 
-    def collect_poly_rgba(self, face, attributes):
+    def collect_poly_rgba(self, mat_idx, attributes):
         # is this suppose to behave similarly to collect_poly_mref ?
-        if face.material_index < len(self.obj_ref.data.materials):
+        if mat_idx < len(self.materials):
             return attributes
 
-    def collect_poly_bface(self, face, attributes):
+    def collect_poly_bface(self, mat_idx, attributes):
         """
         Add <BFace> to the polygon's attributes list.
 
-        @param face: face index.
+        @param mat_idx: material index of the polygon.
         @param attributes: list of polygon's attributes.
 
         @return: list of polygon's attributes.
         """
-        if face.material_index < len(self.obj_ref.data.materials):
-            if not self.obj_ref.data.materials[face.material_index]:
+        if mat_idx < len(self.materials):
+            if not self.materials[mat_idx]:
                 return attributes
 
-            if not self.obj_ref.data.materials[face.material_index].use_backface_culling:
+            if not self.materials[mat_idx].use_backface_culling:
                 attributes.append('<BFace> { 1 }')
 
         return attributes
 
-    def collect_poly_vertexref(self, face, attributes):
+    def collect_poly_vertexref(self, poly_idx, attributes):
         """
         Add <VertexRef> to the polygon's attributes list.
 
-        @param face: face index.
+        @param poly_idx: polygon index.
         @param attributes: list of polygon's attributes.
 
         @return: list of polygon's attributes.
         """
-        vref = ' '.join(map(str, self.poly_vtx_ref[face.index]))
-        attributes.append('<VertexRef> { %s <Ref> { %s }}' % (vref, eggSafeName(self.obj_ref.yabee_name)))
+        vref = ' '.join(map(str, self.poly_vtx_ref[poly_idx]))
+        attributes.append('<VertexRef> { %s <Ref> { %s } }' % (vref, eggSafeName(self.vpool_name)))
         return attributes
 
     def collect_polygons(self):
         """
-        Convert and collect polygons info
+        Convert polygons info. Yields the list of attributes for each polygon.
+        Material dependent attributes are collected once per material.
         """
         tref = self.collect_poly_tref
         mref = self.collect_poly_mref
-        normal = self.collect_poly_normal
         rgba = self.collect_poly_rgba
-        bface = self.collect_poly_bface
         vertexref = self.collect_poly_vertexref
-        polygons = []
-        for face in self.obj_ref.data.polygons:
-            attributes = []
-            tref(face, attributes)
-            mref(face, attributes)
-            normal(face, attributes)
-            rgba(face, attributes)
-            vertexref(face, attributes)
-            poly = '<Polygon> {\n  %s \n}\n' % ('\n  '.join(attributes),)
+        mat_attributes = {}
+        for start in range(0, len(self.poly_material), BATCH_SIZE):
+            polys = np.arange(start, min(start + BATCH_SIZE, len(self.poly_material)))
+            normals = self.collect_poly_normal(polys)
+            for poly_idx, mat_idx, normal in zip(polys.tolist(), self.poly_material[polys].tolist(), normals):
+                if mat_idx not in mat_attributes:
+                    mat_attributes[mat_idx] = tref(mat_idx, [])
+                    mref(mat_idx, mat_attributes[mat_idx])
+                attributes = mat_attributes[mat_idx] + [normal]
+                rgba(mat_idx, attributes)
+                vertexref(poly_idx, attributes)
+                yield attributes
 
-            polygons.append(poly)
-        return polygons
+    def write_vtx_pool(self, stream):
+        """
+        Write the vertex pool in the EGG syntax.
+        """
+        stream.open('<VertexPool> %s' % eggSafeName(self.vpool_name))
+        self.write_vertices(stream)
+        stream.close()
 
-    def get_vtx_pool_str(self):
+    def write_vertices(self, stream):
         """
-        Return the vertex pool string in the EGG syntax.
+        Write the <Vertex> entries of the vertex pool.
         """
-        vtx_pool = '<VertexPool> %s {\n' % eggSafeName(self.obj_ref.yabee_name)
-        vtxs = ''.join(self.collect_vertices())
-        vtxs = vtxs.replace('\n', '\n  ')
-        vtx_pool += vtxs
-        vtx_pool += '}\n'
-        return vtx_pool
+        for idx, attributes in self.collect_vertices():
+            stream.open('<Vertex> %i' % (idx + self.vtx_offset))
+            for attribute in attributes:
+                stream.write_lines(attribute)
+            stream.close()
 
-    def get_polygons_str(self):
+    def write_polygons(self, stream):
         """
-        Return polygons string in the EGG syntax
+        Write polygons in the EGG syntax
         """
-        polygons = '\n' + ''.join(self.collect_polygons())
-        return polygons
+        for attributes in self.collect_polygons():
+            stream.open('<Polygon>')
+            for attribute in attributes:
+                stream.write_line(attribute)
+            stream.close()
 
-    def get_full_egg_str(self):
+    def write_egg(self, stream):
         """
-        Return full mesh data representation in the EGG string syntax
+        Write full mesh data representation in the EGG syntax
         """
-        return '\n'.join((self.get_transform_str(),
-                          self.get_vtx_pool_str(),
-                          self.get_polygons_str()))
+        self.write_transform(stream)
+        self.write_vtx_pool(stream)
+        self.write_polygons(stream)
+
+
+class EGGSharedMeshObjectData(EGGMeshObjectData):
+    """
+    Mesh, shared by several objects. It's written once to the separate EGG file in its
+    local space, the objects reference it with EGGInstanceObjectData.
+    """
+
+    def get_space_matrix(self):
+        return Matrix.Identity(4)
+
+    def write_egg(self, stream):
+        stream.open('<Group> %s' % eggSafeName(self.mesh.name))
+        self.write_vtx_pool(stream)
+        self.write_polygons(stream)
+        stream.close()
+
+
+class EGGInstanceObjectData(EGGBaseObjectData):
+    """
+    Object, which mesh or instanced collection is written to the separate EGG file.
+    The <Instance> sets up the object's local space for the referenced vertices.
+    """
+
+    def __init__(self, obj, file_name):
+        """
+        @param file_name: name of the EGG file, next to the main file.
+        """
+        EGGBaseObjectData.__init__(self, obj)
+        self.file_name = file_name
+
+    def write_egg(self, stream):
+        self.write_transform(stream)
+        stream.open('<Instance>')
+        stream.write_line('<File> { "%s" }' % convertFileNameToPanda(self.file_name))
+        stream.close()
 
 
 # -----------------------------------------------------------------------
@@ -893,115 +1231,255 @@ class EGGActorObjectData(EGGMeshObjectData):
     def __init__(self, obj):
         EGGMeshObjectData.__init__(self, obj)
         self.joint_vtx_ref = self.pre_convert_joint_vtx_ref()
+        for mod in obj.modifiers:
+            if mod.type == 'ARMATURE' and mod.object:
+                get_skeleton(mod.object).add_vrefs(self.joint_vtx_ref)
+
+    def extract_mesh_arrays(self):
+        EGGMeshObjectData.extract_mesh_arrays(self)
+        self.extract_vertex_weights()
+
+    def join_vertex_pool(self):
+        """
+        With MERGE_ACTOR_MESH the actors, skinned to the same armature, share a single
+        vertex pool: the first actor owns it and writes the vertices and the polygons of
+        all parts, the rest of them get the offsets of their vertices in this pool.
+
+        @return: list of the actors, which vertices and polygons this actor writes:
+                 itself, all parts for the pool owner or nothing for the merged part.
+        """
+        if not MERGE_ACTOR_MESH:
+            return [self]
+        armatures = [mod.object for mod in self.obj_ref.modifiers if mod.type == 'ARMATURE' and mod.object]
+        if not armatures:
+            return [self]
+        parts = MERGED_ACTORS.setdefault(armatures[0].name, [])
+        parts.append(self)
+        if len(parts) == 1:
+            return parts
+        self.vpool_name = parts[0].vpool_name
+        self.vtx_offset = parts[-2].vtx_offset + len(parts[-2].pool_loops)
+        print('INFO: %s: merged into the vertex pool %s' % (self.obj_ref.name, self.vpool_name))
+        return []
 
-    def pre_convert_joint_vtx_ref(self):
+    def extract_vertex_weights(self):
         """
-        Collect and convert vertices, assigned to the bones
+        Collect the joint weights into the dense arrays, one row per vertex: vtx_joints holds
+        the vertex group indices (-1 for the empty slot), vtx_weights the weights, the
+        strongest first. Only the groups, named as the bones of the armatures, are joints.
+        With MAX_INFLUENCES the weakest joints are dropped and the rest are renormalized.
+        With WEIGHT_BITS the weights are quantized, so the vertices share <VertexRef> entries.
         """
-        joint_vref = {}
-        idx = 0
-        for face in self.obj_ref.data.polygons:
-            for vertex in face.vertices:
-                for vertgroup in self.obj_ref.data.vertices[vertex].groups:
-                    group_name = self.obj_ref.vertex_groups[vertgroup.group].name
+        bone_names = set()
+        for mod in self.obj_ref.modifiers:
+            if mod.type == 'ARMATURE' and mod.object:
+                bone_names.update(mod.object.data.bones.keys())
+        is_joint = np.array([vg.name in bone_names for vg in self.obj_ref.vertex_groups] + [False])
+
+        # vertex.groups has no foreach_get, so it's the only pass over the vertices in Python
+        vtx_idx, groups, weights = [], [], []
+        for vertex in self.mesh.vertices:
+            for vertgroup in vertex.groups:
+                vtx_idx.append(vertex.index)
+                groups.append(vertgroup.group)
+                weights.append(vertgroup.weight)
+        vtx_idx = np.array(vtx_idx, dtype = np.int32)
+        groups = np.array(groups, dtype = np.int32)
+        weights = np.array(weights, dtype = np.float32)
+
+        # Stale group indices point to the last (False) item of is_joint
+        groups[(groups < 0) | (groups >= len(is_joint))] = -1
+        used = is_joint[groups] & (weights > 0)
+        vtx_idx, groups, weights = vtx_idx[used], groups[used], weights[used]
+
+        # Sort by vertex, then by descending weight, and scatter into the rows
+        order = np.lexsort((-weights, vtx_idx))
+        vtx_idx, groups, weights = vtx_idx[order], groups[order], weights[order]
+        counts = np.bincount(vtx_idx, minlength = len(self.vtx_co))
+        slots = np.arange(len(vtx_idx)) - np.repeat(np.cumsum(counts) - counts, counts)
+        width = int(counts.max(initial = 0))
+
+        self.vtx_joints = np.full((len(counts), width), -1, dtype = np.int32)
+        self.vtx_weights = np.zeros((len(counts), width), dtype = np.float32)
+        self.vtx_joints[vtx_idx, slots] = groups
+        self.vtx_weights[vtx_idx, slots] = weights
+
+        if MAX_INFLUENCES:
+            if width > MAX_INFLUENCES:
+                print('INFO: %s: %i vertices have more than %i joint influences' %
+                      (self.obj_ref.name, int((counts > MAX_INFLUENCES).sum()), MAX_INFLUENCES))
+                self.vtx_joints = self.vtx_joints[:, :MAX_INFLUENCES]
+                self.vtx_weights = self.vtx_weights[:, :MAX_INFLUENCES]
+            totals = self.vtx_weights.sum(axis = 1)
+            nonzero = totals > 0
+            self.vtx_weights[nonzero] /= totals[nonzero, None]
+
+        if WEIGHT_BITS:
+            self.vtx_weights = quantize_weights(self.vtx_weights, WEIGHT_BITS)
+            self.vtx_joints[self.vtx_weights == 0] = -1
 
-                    # Group name = Joint (bone) name
-                    if group_name not in list(joint_vref.keys()):
-                        joint_vref[group_name] = {}
+    def pre_convert_joint_vtx_ref(self):
+        """
+        Collect and convert vertices, assigned to the bones
 
-                    # Object name = vertices pool name
-                    if self.obj_ref.yabee_name not in list(joint_vref[group_name].keys()):
-                        joint_vref[group_name][self.obj_ref.yabee_name] = []
+        @return: dict {group (joint) name: {vertex pool name: [(EGG vertex index, weight)]}}
+        """
+        pool_vtx = self.loop_vtx[self.pool_loops]
+        joints = self.vtx_joints[pool_vtx]
+        weights = self.vtx_weights[pool_vtx]
+        idxs = np.broadcast_to(np.arange(len(pool_vtx))[:, None], joints.shape)
+        used = joints >= 0
+        joints, weights, idxs = joints[used], weights[used], idxs[used]
+        if not len(joints):
+            return {}
 
-                    joint_vref[group_name][self.obj_ref.yabee_name].append((idx, vertgroup.weight))
+        order = np.lexsort((idxs, joints))
+        joints, weights, idxs = joints[order], weights[order], idxs[order]
+        bounds = np.flatnonzero(np.diff(joints)) + 1
+        group_names = self.obj_ref.vertex_groups.keys()
 
-                idx += 1
+        joint_vref = {}
+        idxs = idxs + self.vtx_offset
+        for start, grp_idxs, grp_weights in zip(np.r_[0, bounds].tolist(),
+                                                np.split(idxs, bounds), np.split(weights, bounds)):
+            # Group name = Joint (bone) name
+            joint_vref[group_names[joints[start]]] = {
+                eggSafeName(self.vpool_name): list(zip(grp_idxs.tolist(), grp_weights.tolist()))}
         return joint_vref
 
-    def get_joints_str(self):
+    def get_weld_keys(self):
+        """
+        Vertices with the different skin weights can't be welded, so add the joints and
+        weights of the vertex to the attributes.
         """
-        Make the EGGArmature object from the bones, pass the vertex reference to it,
+        keys = EGGMeshObjectData.get_weld_keys(self)
+        keys.append(np.hstack((self.vtx_joints, self.vtx_weights))[self.loop_vtx])
+        return keys
 
-        :return: the EGG string representation of the joints/bone hierarchy.
+    def write_egg(self, stream):
         """
-        joints_str = ''
-        for mod in self.obj_ref.modifiers:
-            if mod.type != 'ARMATURE':
-                continue
-            armature = EGGArmature(None)
-            armature.make_hierarchy_from_list(mod.object.data.bones)
-            joints_str += armature.get_full_egg_str(self.joint_vtx_ref, mod.object, -1)
-        return joints_str
+        Write the actor in the EGG syntax. The pool owner writes the vertices and the
+        polygons of all merged parts, the rest of them write the transform only.
+        """
+        self.write_transform(stream)
+        if self.merged_parts:
+            stream.open('<VertexPool> %s' % eggSafeName(self.vpool_name))
+            for part in self.merged_parts:
+                part.write_vertices(stream)
+            stream.close()
+            for part in self.merged_parts:
+                part.write_polygons(stream)
 
 
-class EGGAnimJoint(Group):
+class EGGAnimJoint(EGGArmature):
     """
     Representation of the <Joint> animation data.
     Has the same hierarchy as the character's skeleton.
     """
 
-    def make_hierarchy_from_list(self, obj_list):
-        """
-        Old <Group> function
-        -------------------------------
-        This function make <Group> hierarchy from the list of
-        Blender's objects. Self.object is the top level of the created
-        hierarchy. Usually in this case self.object == None
+    def get_full_egg_str(self, anim_info, framerate):
+        return get_egg_str(self.write_egg, anim_info, framerate)
 
-        @param obj_list: tuple or list of blender's objects.
+    def write_egg(self, stream, anim_info, framerate):
         """
-        for obj in obj_list:
-            if (
-                    (obj.parent == self.object) or
-                    ((self.object is None) and
-                     (str(obj.parent) not in map(str, obj_list)) and
-                     (str(obj) not in [str(child.object) for child in self.children]))
-            ):
-                try:
-                    group = self.__class__(obj)
-                except:
-                    print_exc()
-                    return ['ERR_MK_OBJ', ]
-                self.children.append(group)
-                group.make_hierarchy_from_list(obj_list)
-        return []
+        Write the <Joint> animation data, included all joints hierarchy.
 
-    def get_full_egg_str(self, anim_info, framerate, level=0):
-        """
-        Create and return the string representation of the <Joint> animation data, included all joints hierarchy.
+        @param stream: EGGStream to write.
+        @param anim_info: armature data of AnimCollector: '<skeleton>' is (frames, joints, 9)
+                          array of ijkprhxyz channels, '<joints>' maps bone names to the joint index.
+        @param framerate: framerate of the animation.
         """
-        egg_str = ''
         if self.object:
-            egg_str += '%s<Table> %s {\n' % ('  ' * level, eggSafeName(self.object.yabee_name))
-            bone_data = anim_info['<skeleton>'][self.object.yabee_name]
-            egg_str += '%s  <Xfm$Anim> xform {\n' % ('  ' * level)
-            egg_str += '%s    <Scalar> order { sprht }\n' % ('  ' * level)
-            egg_str += '%s    <Scalar> fps { %i }\n' % ('  ' * level, framerate)
-            egg_str += '%s    <Scalar> contents { ijkprhxyz }\n' % ('  ' * level)
-            egg_str += '%s    <V> {\n' % ('  ' * level)
-            for i in range(len(bone_data['r'])):
-                egg_str += '%s      %s %s %s %s %s %s %s %s %s\n' % (
-                    '  ' * level,
-                    STRF(bone_data['i'][i]),
-                    STRF(bone_data['j'][i]),
-                    STRF(bone_data['k'][i]),
-                    STRF(bone_data['p'][i]),
-                    STRF(bone_data['r'][i]),
-                    STRF(bone_data['h'][i]),
-                    STRF(bone_data['x'][i]),
-                    STRF(bone_data['y'][i]),
-                    STRF(bone_data['z'][i]))
-            egg_str += '%s    }\n' % ('  ' * level)
-            egg_str += '%s  }\n' % ('  ' * level)
+            stream.open('<Table> %s' % eggSafeName(self.object.name))
+            # Masked out parents of the joints are written as the empty tables
+            if self.object.name in anim_info['<joints>']:
+                bone_data = anim_info['<skeleton>'][:, anim_info['<joints>'][self.object.name]]
+                if COMPACT_ANIMS:
+                    self.write_xfm_s_anim(stream, bone_data, framerate)
+                else:
+                    self.write_xfm_anim(stream, bone_data, framerate)
             for child in self.children:
-                egg_str += child.get_full_egg_str(anim_info, framerate, level + 1)
-            egg_str += '%s}\n' % ('  ' * level)
+                child.write_egg(stream, anim_info, framerate)
+            stream.close()
 
         else:
             for child in self.children:
-                egg_str += child.get_full_egg_str(anim_info, framerate, level + 1)
+                child.write_egg(stream, anim_info, framerate)
+
+
+    def write_xfm_anim(self, stream, bone_data, framerate):
+        """
+        Write the joint transforms as the <Xfm$Anim> table with all 9 values on every frame.
+
+        @param stream: EGGStream to write.
+        @param bone_data: (frames, 9) array of ijkprhxyz channels.
+        @param framerate: framerate of the animation.
+        """
+        stream.open('<Xfm$Anim> xform')
+        stream.write_line('<Scalar> order { sprht }')
+        stream.write_line('<Scalar> fps { %s }' % STRF(framerate))
+        stream.write_line('<Scalar> contents { ijkprhxyz }')
+        stream.open('<V>')
+        for values_str in STRF.rows(bone_data):
+            stream.write_line(values_str)
+        stream.close()
+        stream.close()
+
+    def write_xfm_s_anim(self, stream, bone_data, framerate):
+        """
+        Write the joint transforms as the <Xfm$Anim_S$> table with the separate channels.
+        The channel, which doesn't change within the output precision, is written once,
+        and it's omitted if it's equal to the default (1 for scale, 0 for the rest).
+
+        @param stream: EGGStream to write.
+        @param bone_data: (frames, 9) array of ijkprhxyz channels.
+        @param framerate: framerate of the animation.
+        """
+        stream.open('<Xfm$Anim_S$> xform')
+        stream.write_line('<Scalar> fps { %s }' % STRF(framerate))
+        stream.write_line('<Char*> order { sprht }')
+        for col, channel in enumerate('ijkprhxyz'):
+            values = bone_data[:, col]
+            if np.ptp(values) <= STRF.tolerance:
+                values = values[:1]
+                if abs(values[0] - (1.0 if channel in 'ijk' else 0.0)) <= STRF.tolerance:
+                    continue
+            stream.open('<S$Anim> %s' % channel)
+            stream.write_line('<V> { %s }' % STRF.join(values))
+            stream.close()
+        stream.close()
+
+
+def get_masked_bones(arm, bone_mask):
+    """
+    Resolve the bone mask of the animation into the bone names.
 
-        return egg_str
+    @param arm: Blender's Armature.
+    @param bone_mask: None for all bones or tuple (mode, names), where mode is 'INCLUDE'
+                      or 'EXCLUDE' and names are the bone or the bone collection names.
+    @return: list of the masked in bone names in the armature's order.
+    """
+    names = arm.pose.bones.keys()
+    if not bone_mask:
+        return names
+    mode, mask_names = bone_mask
+    # Bone collections since Blender 4.0, bone groups before
+    collections = getattr(arm.data, 'collections_all', getattr(arm.data, 'collections', None))
+    bone_groups = getattr(arm.pose, 'bone_groups', None)
+    masked = set()
+    for name in mask_names:
+        if name in arm.data.bones:
+            masked.add(name)
+        elif collections is not None and name in collections:
+            masked.update(bone.name for bone in collections[name].bones)
+        elif bone_groups is not None and name in bone_groups:
+            masked.update(bone.name for bone in arm.pose.bones
+                          if bone.bone_group and bone.bone_group.name == name)
+        else:
+            print('WARNING: %s: no bone or bone collection "%s" for the bone mask' % (arm.name, name))
+    if mode == 'EXCLUDE':
+        return [name for name in names if name not in masked]
+    return [name for name in names if name in masked]
 
 
 class AnimCollector:
@@ -1009,162 +1487,733 @@ class AnimCollector:
     Collect an armature and a shapekeys animation data and convert it to the EGG string.
     """
 
-    def __init__(self, obj_list, start_f, stop_f, framerate, name, action=None):
+    def __init__(self, obj_list, start_f, stop_f, framerate, name, action=None, bone_mask=None):
         """
+        The data is recorded by AnimSampler, which calls record_frame() for each of the frames.
+
         @param obj_list: list or tuple of the Blender's objects for which needed to collect animation data.
         @param start_f: number of the "from" frame.
         @param stop_f: number of the "to" frame.
         @param framerate: framerate for the given animation.
         @param name: name of the animation for access in the Panda.
+        @param action: action to assign to the armatures while sampling, or None to use the assigned ones.
+        @param bone_mask: None or tuple (mode, names), see get_masked_bones().
         """
         self.obj_list = obj_list
         self.start_f = start_f
         self.stop_f = stop_f
         if self.start_f == self.stop_f:
             self.stop_f += 1
+        self.frames = range(self.start_f, self.stop_f)
         self.framerate = framerate
         self.name = name
+        self.action = action
         self.bone_groups = {}
-        for arm in bpy.data.armatures:
-            arm.pose_position = 'POSE'
         self.obj_anim_ref = {}
+        self.armatures = []
+        self.morph_targets = []
+        # Armature space matrices of the bones, (frames, bones, 4, 4) array per armature.
+        # They are converted into the channels by finish().
+        self.pose_matrices = {}
+        # World matrices of the armature objects, (frames, 4, 4) array per armature.
+        # Root bones are moved by them, so the armature object motion is kept.
+        self.arm_matrices = {}
+        # Targets, recorded by record_direct_*() and skipped by record_frame()
+        self.direct_bones = {}
+        self.direct_morphs = set()
+        # Bones, which get the <Table> data, and the bones, which have to be sampled for
+        # them: the masked in bones and their parents. Indices are in pose.bones order.
+        self.joint_bones = {}
+        self.sampled_bones = {}
+        # Frames, which are recorded. The rest hold the values of the previous recorded frame.
+        self.sampled_frames = np.ones(len(self.frames), dtype = bool)
 
         for obj in obj_list:
             if obj.__class__ != bpy.types.Bone:
                 if obj.type == 'MESH':
                     if obj.data.shape_keys and (len(obj.data.shape_keys.key_blocks) > 1):
-                        if obj.yabee_name not in list(self.obj_anim_ref.keys()):
-                            self.obj_anim_ref[obj.yabee_name] = {}
-                        self.obj_anim_ref[obj.yabee_name]['morph'] = self.collect_morph_anims(obj)
+                        self.morph_targets.append(obj)
+                        key_names = obj.data.shape_keys.key_blocks.keys()[1:]
+                        self.obj_anim_ref.setdefault(obj.name, {}).update({
+                            'morph': np.zeros((len(self.frames), len(key_names))),
+                            '<shape_keys>': key_names})
 
                 elif obj.type == 'ARMATURE':
-                    if action and obj.animation_data:
-                        obj.animation_data.action = action
-                    self.bone_groups[obj.yabee_name] = EGGAnimJoint(None)
-                    self.bone_groups[obj.yabee_name].make_hierarchy_from_list(obj.data.bones)
-                    if obj.yabee_name not in list(self.obj_anim_ref.keys()):
-                        self.obj_anim_ref[obj.yabee_name] = {}
-                    self.obj_anim_ref[obj.yabee_name]['<skeleton>'] = self.collect_arm_anims(obj)
-
-    def collect_morph_anims(self, obj):
-        """
-        Collect an animation data for the morph target (shapekeys).
+                    joints = get_masked_bones(obj, bone_mask)
+                    if obj.name in KEPT_JOINTS:
+                        joints = [joint for joint in joints if joint in KEPT_JOINTS[obj.name]]
+                    if not joints:
+                        print('INFO: %s: all bones of %s are masked out' % (self.name, obj.name))
+                        continue
+                    skeleton = get_skeleton(obj)
+                    names = skeleton.names
+                    sampled = set(joints)
+                    for joint in joints:
+                        sampled.update(bone.name for bone in obj.pose.bones[joint].parent_recursive)
+
+                    self.armatures.append(obj)
+                    self.bone_groups[obj.name] = EGGAnimJoint(None)
+                    self.bone_groups[obj.name].make_hierarchy_from_index(skeleton.get_children_index(sampled))
+                    bones_num = len(names)
+                    # '<skeleton>' is set by finish(): (frames, joints, 9) array of ijkprhxyz
+                    self.obj_anim_ref.setdefault(obj.name, {}).update({
+                        '<skeleton>': None,
+                        '<joints>': {name: idx for idx, name in enumerate(joints)}})
+                    self.pose_matrices[obj.name] = np.zeros((len(self.frames), bones_num, 4, 4))
+                    # Bones, evaluated from the F-curves, need a static armature, so the current
+                    # matrix stays for them. record_arm_frame() overwrites it for the sampled frames.
+                    self.arm_matrices[obj.name] = np.tile(np.array(obj.matrix_world), (len(self.frames), 1, 1))
+                    self.direct_bones[obj.name] = np.zeros(bones_num, dtype = bool)
+                    joint_set = set(joints)
+                    self.joint_bones[obj.name] = np.array([idx for idx, name in enumerate(names) if name in joint_set],
+                                                          dtype = np.int32)
+                    self.sampled_bones[obj.name] = np.array([name in sampled for name in names], dtype = bool)
+
+    def needs_frame_set(self):
+        """
+        @return: True if some of the targets are not recorded by record_direct_*().
+        """
+        if [obj for obj in self.morph_targets if obj.name not in self.direct_morphs]:
+            return True
+        for name, direct_bones in self.direct_bones.items():
+            if (self.sampled_bones[name] & ~direct_bones).any():
+                return True
+        return False
+
+    def find_static_frames(self):
+        """
+        Skip the frames, where none of the F-curves changes the values. For the targets,
+        evaluated from their F-curves alone, these are the padding before the first and after
+        the last key and the holds between the keys. The bones with constraints and drivers are
+        sampled by frame_set(), so only the padding around the keys of all F-curves of the rig
+        is skipped for them. If any target depends on something else, all frames are sampled.
+        """
+        frames = np.array(self.frames)
+        changes = np.zeros(len(frames), dtype = bool)
+        changes[0] = True
+        fcurve_sets = []
+        for arm in self.armatures:
+            fcurves = get_action_fcurves(arm)
+            names = {bone.name for bone, sampled in zip(arm.pose.bones, self.sampled_bones[arm.name]) if sampled}
+            if names.issubset(get_direct_bones(arm, fcurves)):
+                # F-curves of the masked out bones don't matter
+                fcurve_sets.append({path: fc for path, fc in fcurves.items()
+                                    if get_fcurve_bone(path[0]) in names})
+                continue
+            fcurves = get_rig_fcurves(arm)
+            if fcurves is None:
+                return
+            rig_changes = np.zeros(len(frames), dtype = bool)
+            for fc in fcurves.values():
+                rig_changes |= get_fcurve_changes(fc, frames)
+            changed = np.flatnonzero(rig_changes[1:]) + 1
+            if len(changed):
+                changes[changed[0]:changed[-1] + 1] = True
+        for obj in self.morph_targets:
+            fcurves = get_shape_key_fcurves(obj)
+            if fcurves is None:
+                return
+            fcurve_sets.append(fcurves)
+        for fcurves in fcurve_sets:
+            for fc in fcurves.values():
+                changes |= get_fcurve_changes(fc, frames)
+        self.sampled_frames = changes
+        print('INFO: %s: %i of %i frames are sampled' % (self.name, changes.sum(), len(frames)))
+
+    def record_frame(self, frame):
+        """
+        Record the animation data of the current scene frame.
+
+        @param frame: number of the current frame.
+        """
+        for obj in self.morph_targets:
+            if obj.name not in self.direct_morphs:
+                self.record_morph_frame(obj, frame - self.start_f)
+        for arm in self.armatures:
+            self.record_arm_frame(arm, frame - self.start_f)
+
+    def record_morph_frame(self, obj, frame_idx):
+        """
+        Record the shapekeys values of the morph target.
 
         @param obj: Blender's object for which need to collect an animation data
+        @param frame_idx: index of the frame in the collector's frames.
         """
-        keys = {}
-        if obj.data.shape_keys and (len(obj.data.shape_keys.key_blocks) > 1):
-            current_frame = bpy.context.scene.frame_current
-            anim_dict = {}
-            for frame in range(self.start_f, self.stop_f):
-                bpy.context.scene.frame_current = frame
-                bpy.context.scene.frame_set(frame)
-                for i in range(1, len(obj.data.shape_keys.key_blocks)):
-                    key = obj.data.shape_keys.key_blocks[i]
-                    if key.name not in list(keys.keys()):
-                        keys[key.name] = []
-                    keys[key.name].append(key.value)
-            bpy.context.scene.frame_current = current_frame
-        return keys
+        values = foreach_get_array(obj.data.shape_keys.key_blocks, 'value')
+        self.obj_anim_ref[obj.name]['morph'][frame_idx] = values[1:]
 
-    def collect_arm_anims(self, arm):
+    def record_arm_frame(self, arm, frame_idx):
         """
-        Collect an animation data for the skeleton (Armature).
+        Record the pose matrices of the skeleton (Armature) bones.
 
         @param arm: Blender's Armature for which need to collect an animation data
-        """
-        current_f = bpy.context.scene.frame_current
-        anim_dict = {}
-        for frame in range(self.start_f, self.stop_f):
-            bpy.context.scene.frame_current = frame
-            bpy.context.scene.frame_set(frame)
-            for bone in arm.pose.bones:
-                if bone.yabee_name not in list(anim_dict.keys()):
-                    anim_dict[bone.yabee_name] = {}
-                for keyword in 'ijkabcrphxyz':
-                    if keyword not in list(anim_dict[bone.yabee_name].keys()):
-                        anim_dict[bone.yabee_name][keyword] = []
-                if bone.parent:
-                    matrix = bone.parent.matrix.inverted() @ bone.matrix
-                else:
-                    matrix = arm.matrix_world @ bone.matrix
-
-                i, j, k = matrix.to_scale()
-                anim_dict[bone.yabee_name]['i'].append(i)
-                anim_dict[bone.yabee_name]['j'].append(j)
-                anim_dict[bone.yabee_name]['k'].append(k)
-                p, r, h = matrix.to_euler()
-                anim_dict[bone.yabee_name]['p'].append(p / pi * 180)
-                anim_dict[bone.yabee_name]['r'].append(r / pi * 180)
-                anim_dict[bone.yabee_name]['h'].append(h / pi * 180)
-                x, y, z = matrix.to_translation()
-                anim_dict[bone.yabee_name]['x'].append(x)
-                anim_dict[bone.yabee_name]['y'].append(y)
-                anim_dict[bone.yabee_name]['z'].append(z)
-        bpy.context.scene.frame_current = current_f
-        return anim_dict
-
-    def get_morph_anim_str(self, obj_name):
-        """ Create and return the EGG string of the morph animation for
-        the given object.
-
+        @param frame_idx: index of the frame in the collector's frames.
+        """
+        sampled = self.sampled_bones[arm.name] & ~self.direct_bones[arm.name]
+        # foreach_get gives the matrices in Blender's column-major order
+        matrices = foreach_get_array(arm.pose.bones, 'matrix', width = 16).reshape((-1, 4, 4))
+        self.pose_matrices[arm.name][frame_idx, sampled] = matrices[sampled].transpose((0, 2, 1))
+        self.arm_matrices[arm.name][frame_idx] = np.array(arm.matrix_world)
+
+    def record_direct_bones(self, arm, pose_matrices):
+        """
+        Record the bones, evaluated from the F-curves for the sampled frames of the collector.
+
+        @param arm: Blender's Armature.
+        @param pose_matrices: dict {bone name: [armature space matrix for each sampled frame]}.
+        """
+        direct_bones = self.direct_bones[arm.name]
+        for idx, bone in enumerate(arm.pose.bones):
+            if bone.name in pose_matrices:
+                direct_bones[idx] = True
+                self.pose_matrices[arm.name][self.sampled_frames, idx] = np.array(pose_matrices[bone.name])
+
+    def finish(self):
+        """
+        Fill the skipped frames, convert the recorded pose matrices into the transforms
+        relative to the parent bones and decompose them into the ijkprhxyz channels.
+        """
+        if not self.sampled_frames.all():
+            indices = np.arange(len(self.frames))
+            held = np.maximum.accumulate(np.where(self.sampled_frames, indices, 0))
+            for obj in self.morph_targets:
+                self.obj_anim_ref[obj.name]['morph'] = self.obj_anim_ref[obj.name]['morph'][held]
+            for name in self.pose_matrices:
+                self.pose_matrices[name] = self.pose_matrices[name][held]
+                self.arm_matrices[name] = self.arm_matrices[name][held]
+
+        for arm in self.armatures:
+            matrices = self.pose_matrices.pop(arm.name)
+            joints = self.joint_bones[arm.name]
+            parents = get_skeleton(arm).parents[joints]
+            local = np.empty((len(matrices), len(joints), 4, 4))
+            has_parent = parents >= 0
+            local[:, has_parent] = np.linalg.inv(matrices[:, parents[has_parent]]) @ \
+                matrices[:, joints[has_parent]]
+            local[:, ~has_parent] = self.arm_matrices.pop(arm.name)[:, None] @ matrices[:, joints[~has_parent]]
+
+            self.obj_anim_ref[arm.name]['<skeleton>'] = decompose_matrices(local)
+
+    def simplify(self, rotation_tolerance, unit_tolerance):
+        """
+        Reduce the sampled data within the tolerances: snap the channels, which vary less than
+        the tolerance, to the constant and lower the fps by the largest frame stride, which
+        keeps every channel of the bundle within the tolerance. Panda plays all tables of the
+        bundle at one frame rate, so the stride is chosen per object, not per bone.
+
+        @param rotation_tolerance: max error of rotation, in degrees.
+        @param unit_tolerance: max error of scale, translation and shapekeys values.
+        """
+        tolerances = np.array([unit_tolerance] * 3 + [rotation_tolerance] * 3 + [unit_tolerance] * 3)
+        defaults = np.array([1.0] * 3 + [0.0] * 6)
+        for arm in self.armatures:
+            data = self.obj_anim_ref[arm.name]
+            channels, stride = self.simplify_channels(data['<skeleton>'], tolerances)
+            data['<skeleton>'] = channels
+            data['<fps>'] = self.framerate / stride
+
+            # Values, written per joint: see EGGAnimJoint.write_xfm_s_anim()
+            varying = np.ptp(channels, axis = 0) > STRF.tolerance
+            written = varying * len(channels) + (~varying & (np.abs(channels[0] - defaults) > STRF.tolerance))
+            if not COMPACT_ANIMS:
+                written = np.full_like(written, len(channels))
+            for name, idx in data['<joints>'].items():
+                print('INFO: %s: %s/%s: %i -> %i values' % (self.name, arm.name, name,
+                                                           len(self.frames) * 9, written[idx].sum()))
+
+        for obj in self.morph_targets:
+            data = self.obj_anim_ref[obj.name]
+            data['morph'], stride = self.simplify_channels(data['morph'], unit_tolerance)
+            data['<fps>'] = self.framerate / stride
+            print('INFO: %s: %s: %i -> %i frames' % (self.name, obj.name, len(self.frames), len(data['morph'])))
+
+    @staticmethod
+    def simplify_channels(channels, tolerance):
+        """
+        @param channels: (frames, ...) array of the sampled channels.
+        @param tolerance: max error, scalar or per channel array.
+        @return: tuple (simplified channels, frame stride).
+        """
+        snapped = channels.copy()
+        constant = np.ptp(channels, axis = 0) <= tolerance
+        snapped[:, constant] = channels[:, constant].mean(axis = 0)
+        stride = find_anim_stride(channels, snapped, tolerance)
+        return snapped[::stride], stride
+
+    def record_direct_morph(self, obj, values):
+        """
+        Record the shapekeys, evaluated from the F-curves for the sampled frames of the collector.
+
+        @param obj: Blender's object with the shapekeys.
+        @param values: dict {shapekey name: [value for each sampled frame]}.
+        """
+        self.direct_morphs.add(obj.name)
+        data = self.obj_anim_ref[obj.name]
+        for idx, name in enumerate(data['<shape_keys>']):
+            data['morph'][self.sampled_frames, idx] = values[name]
+
+    def write_morph_anim(self, stream, obj_name):
+        """
+        Write the EGG morph animation for the given object.
+
+        @param stream: EGGStream to write.
         @param obj_name: name of the Blender's object
         """
-        morph_str = ''
         data = self.obj_anim_ref[obj_name]
-        if 'morph' in list(data.keys()):
-            morph_str += '<Table> morph {\n'
-            for key, anim_vals in data['morph'].items():
-                morph_str += '  <S$Anim> %s {\n' % eggSafeName(key)
-                morph_str += '    <Scalar> fps { %i }\n' % self.framerate
-                morph_str += '    <V> { %s }\n' % (' '.join(map(STRF, anim_vals)))
-                morph_str += '  }\n'
-            morph_str += '}\n'
-        return morph_str
+        if 'morph' in data:
+            stream.open('<Table> morph')
+            for idx, key in enumerate(data['<shape_keys>']):
+                stream.open('<S$Anim> %s' % eggSafeName(key))
+                stream.write_line('<Scalar> fps { %s }' % STRF(data.get('<fps>', self.framerate)))
+                stream.write_line('<V> { %s }' % STRF.join(data['morph'][:, idx]))
+                stream.close()
+            stream.close()
 
-    def get_skeleton_anim_str(self, obj_name):
+    def write_skeleton_anim(self, stream, obj_name):
         """
-        Create and return the EGG string of the Armature animation for the given object.
+        Write the EGG Armature animation for the given object.
 
+        @param stream: EGGStream to write.
         @param obj_name: name of the Blender's object
         """
-        skel_str = ''
         data = self.obj_anim_ref[obj_name]
-        if '<skeleton>' in list(data.keys()):
-            skel_str += '<Table> "<skeleton>" {\n'
-            for line in self.bone_groups[obj_name].get_full_egg_str(data, self.framerate, -1).splitlines():
-                skel_str += '  %s\n' % line
-            skel_str += '}\n'
-        return skel_str
+        if '<skeleton>' in data:
+            stream.open('<Table> "<skeleton>"')
+            self.bone_groups[obj_name].write_egg(stream, data, data.get('<fps>', self.framerate))
+            stream.close()
 
-    def get_full_egg_str(self):
+    def write_egg(self, stream):
         """
-        Create and return the full EGG string for the animation, which has been setup in the object's constructor
+        Write the full EGG data for the animation, which has been setup in the object's constructor
         """
-        egg_str = ''
         if self.obj_anim_ref:
-            egg_str += '<Table> {\n'
+            stream.open('<Table>')
             for obj_name, obj_data in self.obj_anim_ref.items():
-                yabee_obj_name = bpy.data.objects[obj_name].yabee_name
                 if self.name:
                     anim_name = self.name
                 else:
                     anim_name = obj_name
 
                 if SEPARATE_ANIM_FILE or ANIM_ONLY:
-                    egg_str += '  <Bundle> %s {\n' % eggSafeName(yabee_obj_name)
+                    stream.open('<Bundle> %s' % eggSafeName(obj_name))
                 else:
-                    egg_str += '  <Bundle> %s {\n' % eggSafeName(anim_name)
+                    stream.open('<Bundle> %s' % eggSafeName(anim_name))
+
+                self.write_skeleton_anim(stream, obj_name)
+                self.write_morph_anim(stream, obj_name)
+
+                stream.close()
+            stream.close()
+
+    def get_full_egg_str(self):
+        return get_egg_str(self.write_egg)
+
+
+def get_action_fcurves(id_data):
+    """
+    Collect F-curves of the active action of the datablock.
+
+    @param id_data: Blender's object or shapekeys (Key) datablock.
+    @return: dict {(data_path, array_index): FCurve} or None if the animation is not
+             only the active action (NLA tracks, blending or tweak mode).
+    """
+    anim = id_data.animation_data
+    if not anim:
+        return {}
+    if anim.use_tweak_mode or getattr(anim, 'action_influence', 1.0) < 1.0 or \
+            getattr(anim, 'action_blend_type', 'REPLACE') != 'REPLACE':
+        return None
+    if anim.use_nla and [track for track in anim.nla_tracks if not track.mute and track.strips]:
+        return None
+    if not anim.action:
+        return {}
+    fcurves = getattr(anim.action, 'fcurves', None)
+    if fcurves is None:
+        return None
+    return {(fc.data_path, fc.array_index): fc for fc in fcurves if not fc.mute}
+
+
+def get_fcurve_bone(data_path):
+    """
+    @param data_path: F-curve data path.
+    @return: name of the pose bone, which the path points to, or None.
+    """
+    match = re.match(r'pose\.bones\["(.*?)(?<!\\)"\]', data_path)
+    return match.group(1).replace('\\"', '"') if match else None
+
+
+def evaluate_fcurve_channel(fcurves, data_path, current, frames):
+    """
+    Evaluate the vector property through the F-curves.
+
+    @param fcurves: dict, returned by get_action_fcurves().
+    @param data_path: path of the property.
+    @param current: current value of the property, used for not animated components.
+    @param frames: list of frames.
+    @return: list of component value lists.
+    """
+    channel = []
+    for idx, value in enumerate(current):
+        fc = fcurves.get((data_path, idx))
+        if fc:
+            channel.append([fc.evaluate(frame) for frame in frames])
+        else:
+            channel.append([value] * len(frames))
+    return channel
+
+
+def get_direct_bones(arm, fcurves):
+    """
+    Find the bones, which pose can be computed straight from the F-curves: bones without
+    constraints and drivers, if all their parents are such bones too. The armature object
+    itself must be static, and no bone may be moved by IK.
+
+    @param arm: Blender's Armature.
+    @param fcurves: dict, returned by get_action_fcurves().
+    @return: set of bone names.
+    """
+    if fcurves is None or arm.parent or arm.constraints:
+        return set()
+    if [path for path, idx in fcurves if not path.startswith('pose.bones[')]:
+        return set()
+
+    driven = set()
+    for driver in (arm.animation_data.drivers if arm.animation_data else ()):
+        match = re.match(r'pose\.bones\[".*?(?<!\\)"\]', driver.data_path)
+        if not match:
+            return set()
+        driven.add(match.group(0))
+
+    pose_bones = arm.pose.bones
+    for bone in pose_bones:
+        if [con for con in bone.constraints if con.type in ('IK', 'SPLINE_IK')]:
+            return set()
+
+    direct = {}
+
+    def is_direct(bone):
+        if bone.name not in direct:
+            direct[bone.name] = not bone.constraints and bone.path_from_id() not in driven and \
+                                (not bone.parent or is_direct(bone.parent))
+        return direct[bone.name]
+
+    return {bone.name for bone in pose_bones if is_direct(bone)}
+
+
+def evaluate_pose_matrices(arm, bone_names, fcurves, frames):
+    """
+    Compute the pose (armature space) matrices of the bones from the F-curves.
+
+    @param arm: Blender's Armature.
+    @param bone_names: bones, returned by get_direct_bones().
+    @param fcurves: dict, returned by get_action_fcurves().
+    @param frames: list of frames.
+    @return: dict {bone name: [Matrix for each frame]}.
+    """
+    pose_matrices = {}
+    pose_bones = [bone for bone in arm.pose.bones if bone.name in bone_names]
+    # Parents are computed before children
+    pose_bones.sort(key = lambda bone: len(bone.parent_recursive))
+    for bone in pose_bones:
+        path = bone.path_from_id()
+        loc = evaluate_fcurve_channel(fcurves, path + '.location', bone.location, frames)
+        scale = evaluate_fcurve_channel(fcurves, path + '.scale', bone.scale, frames)
+        if bone.rotation_mode == 'QUATERNION':
+            rot = evaluate_fcurve_channel(fcurves, path + '.rotation_quaternion', bone.rotation_quaternion, frames)
+            to_matrix = lambda w, x, y, z: Quaternion((w, x, y, z)).normalized().to_matrix()
+        elif bone.rotation_mode == 'AXIS_ANGLE':
+            rot = evaluate_fcurve_channel(fcurves, path + '.rotation_axis_angle', bone.rotation_axis_angle, frames)
+            to_matrix = lambda a, x, y, z: Matrix.Rotation(a, 3, Vector((x, y, z)).normalized()) \
+                if Vector((x, y, z)).length else Matrix.Identity(3)
+        else:
+            rot = evaluate_fcurve_channel(fcurves, path + '.rotation_euler', bone.rotation_euler, frames)
+            to_matrix = lambda x, y, z, order = bone.rotation_mode: Euler((x, y, z), order).to_matrix()
+
+        bone_data = bone.bone
+        parent = bone.parent
+        matrices = []
+        for idx, (l, r, sc) in enumerate(zip(zip(*loc), zip(*rot), zip(*scale))):
+            basis = Matrix.Translation(l) @ to_matrix(*r).to_4x4() @ Matrix.Diagonal(sc).to_4x4()
+            if parent:
+                matrices.append(bone_data.convert_local_to_pose(
+                    basis, bone_data.matrix_local,
+                    parent_matrix = pose_matrices[parent.name][idx],
+                    parent_matrix_local = parent.bone.matrix_local))
+            else:
+                matrices.append(bone_data.convert_local_to_pose(basis, bone_data.matrix_local))
+        pose_matrices[bone.name] = matrices
+    return pose_matrices
+
+
+def get_rig_fcurves(arm):
+    """
+    Collect the F-curves, which the pose of the armature, sampled by frame_set(), depends on:
+    the bone and the object channels of the action. The constraints and the drivers may
+    read the armature itself only, then its bones are animated by the same F-curves.
+
+    @param arm: Blender's Armature.
+    @return: dict, returned by get_action_fcurves(), or None if the pose may depend
+             on other objects or on the time.
+    """
+    fcurves = get_action_fcurves(arm)
+    if fcurves is None or arm.parent:
+        return None
+    for con in list(arm.constraints) + [con for bone in arm.pose.bones for con in bone.constraints]:
+        targets = [getattr(con, 'target', None), getattr(con, 'pole_target', None)]
+        targets += [target.target for target in getattr(con, 'targets', ())]
+        if [target for target in targets if target not in (None, arm)]:
+            return None
+    for driver in (arm.animation_data.drivers if arm.animation_data else ()):
+        if driver.driver.type == 'SCRIPTED' and 'frame' in driver.driver.expression:
+            return None
+        for var in driver.driver.variables:
+            if [target for target in var.targets if target.id not in (None, arm, arm.data)]:
+                return None
+    return fcurves
+
+
+def get_shape_key_fcurves(obj):
+    """
+    @param obj: Blender's object with the shapekeys.
+    @return: dict, returned by get_action_fcurves(), or None if the shapekeys are
+             driven or not relative and their values don't depend on the F-curves only.
+    """
+    shape_keys = obj.data.shape_keys
+    if not shape_keys.use_relative or (shape_keys.animation_data and shape_keys.animation_data.drivers):
+        return None
+    return get_action_fcurves(shape_keys)
+
 
-                for line in self.get_skeleton_anim_str(obj_name).splitlines():
-                    egg_str += '    %s\n' % line
+def get_fcurve_changes(fc, frames):
+    """
+    Find the frames, where the F-curve value may differ from the value at the previous
+    frame. The value is held between the keys with the constant interpolation, between
+    the keys with equal values and flat handles, and outside of the keys with the constant
+    extrapolation.
+
+    @param fc: Blender's F-curve.
+    @param frames: array of frames.
+    @return: bool array, True for the frames, which have to be evaluated.
+    """
+    changes = np.zeros(len(frames), dtype = bool)
+    changes[0] = True
+    keys = fc.keyframe_points
+    if len(fc.modifiers):
+        changes[:] = True
+        return changes
+    if not len(keys):
+        return changes
+
+    co = foreach_get_array(keys, 'co', width = 2)
+    left = foreach_get_array(keys, 'handle_left', width = 2)
+    right = foreach_get_array(keys, 'handle_right', width = 2)
+    # Segment 0 is before the first key, segment i lies between the keys i - 1 and i,
+    # segment len(keys) is after the last key.
+    static = np.zeros(len(keys) + 1, dtype = bool)
+    static[0] = static[-1] = fc.extrapolation == 'CONSTANT'
+    for idx, key in enumerate(keys[:-1]):
+        value = co[idx, 1]
+        flat = value == co[idx + 1, 1] and \
+            (key.interpolation != 'BEZIER' or right[idx, 1] == value == left[idx + 1, 1])
+        static[idx + 1] = key.interpolation == 'CONSTANT' or flat
+
+    segments = np.searchsorted(co[:, 0], frames, side = 'right')
+    changes |= ~static[segments]
+    changes[1:] |= segments[1:] != segments[:-1]
+    return changes
+
+
+def evaluate_shape_keys(obj, frames):
+    """
+    Compute the shapekeys values from the F-curves.
+
+    @param obj: Blender's object with the shapekeys.
+    @param frames: list of frames.
+    @return: dict {shapekey name: [value for each frame]} or None if the shapekeys are
+             driven or not relative and can't be computed directly.
+    """
+    shape_keys = obj.data.shape_keys
+    fcurves = get_shape_key_fcurves(obj)
+    if fcurves is None:
+        return None
+    values = {}
+    for key in shape_keys.key_blocks[1:]:
+        channel, = evaluate_fcurve_channel(fcurves, key.path_from_id('value'), (key.value,), frames)
+        values[key.name] = [min(max(value, key.slider_min), key.slider_max) for value in channel]
+    return values
+
+
+def get_action_targets(action, obj_list):
+    """
+    Find the objects, which the action animates: armatures, which have any of the bones
+    referenced by the F-curves, and meshes, which have any of the referenced shapekeys.
 
-                for line in self.get_morph_anim_str(obj_name).splitlines():
-                    egg_str += '    %s\n' % line
+    @param action: Blender's action.
+    @param obj_list: list of the objects for export.
+    @return: list of the matching objects.
+    """
+    bone_names = set()
+    key_names = set()
+    for fc in getattr(action, 'fcurves', ()):
+        match = re.match(r'(pose\.bones|key_blocks)\["(.*?)(?<!\\)"\]', fc.data_path)
+        if match:
+            name = match.group(2).replace('\\"', '"')
+            (bone_names if match.group(1) == 'pose.bones' else key_names).add(name)
+
+    id_root = getattr(action, 'id_root', '')
+    targets = []
+    skipped = []
+    for obj in obj_list:
+        if obj.__class__ == bpy.types.Bone:
+            continue
+        if obj.type == 'ARMATURE':
+            if id_root != 'KEY' and bone_names.intersection(obj.pose.bones.keys()):
+                targets.append(obj)
+            else:
+                skipped.append(obj.name)
+        elif obj.type == 'MESH' and obj.data.shape_keys and len(obj.data.shape_keys.key_blocks) > 1:
+            if id_root != 'OBJECT' and key_names.intersection(obj.data.shape_keys.key_blocks.keys()):
+                targets.append(obj)
+            else:
+                skipped.append(obj.name)
+    if targets and skipped:
+        print('INFO: Action %s doesn\'t match %s' % (action.name, ', '.join(skipped)))
+    return targets
 
-                egg_str += '  }\n'
-            egg_str += '}\n'
-        return egg_str
+
+class AnimSampler:
+    """
+    Frame scheduler for the AnimCollectors. The collectors, which use the same action,
+    are sampled together: the union of their frames is visited once and every collector
+    records the frames it needs. So the scene is evaluated once per unique frame
+    and not once per frame of each collector and target.
+    """
+
+    def __init__(self, anim_collectors):
+        """
+        @param anim_collectors: list of AnimCollector.
+        """
+        self.action_groups = {}
+        for anim_collector in anim_collectors:
+            self.action_groups.setdefault(anim_collector.action, []).append(anim_collector)
+
+    def run(self):
+        """
+        Sample all frames of all collectors. The pose position, the assigned actions
+        and the current frame are restored back, when all data is collected.
+        """
+        scene = bpy.context.scene
+        current_frame = scene.frame_current
+        pose_positions = {arm: arm.pose_position for arm in bpy.data.armatures}
+        for arm in bpy.data.armatures:
+            arm.pose_position = 'POSE'
+        try:
+            for action, anim_collectors in self.action_groups.items():
+                self.sample_action(action, anim_collectors)
+        finally:
+            for arm, pose_position in pose_positions.items():
+                arm.pose_position = pose_position
+            scene.frame_set(current_frame)
+
+    def sample_action(self, action, anim_collectors):
+        """
+        Assign the action to the armatures and the shapekeys and sample the frames of the collectors.
+
+        @param action: Blender's action or None to keep the assigned actions.
+        @param anim_collectors: list of AnimCollector, which use this action.
+        """
+        # datablock -> previous action, None if animation data has been created for the export
+        assigned_actions = {}
+        try:
+            if action:
+                for anim_collector in anim_collectors:
+                    targets = anim_collector.armatures + [obj.data.shape_keys for obj in anim_collector.morph_targets]
+                    for id_data in targets:
+                        if id_data in assigned_actions:
+                            continue
+                        if id_data.animation_data:
+                            assigned_actions[id_data] = id_data.animation_data.action
+                        else:
+                            assigned_actions[id_data] = None
+                            id_data.animation_data_create()
+                        id_data.animation_data.action = action
+
+            if SKIP_STATIC_FRAMES:
+                for anim_collector in anim_collectors:
+                    anim_collector.find_static_frames()
+
+            if DIRECT_FCURVES:
+                self.evaluate_direct(anim_collectors)
+
+            sampled_collectors = [anim_collector for anim_collector in anim_collectors
+                                  if anim_collector.needs_frame_set()]
+            frames = sorted(set().union(*[np.array(anim_collector.frames)[anim_collector.sampled_frames].tolist()
+                                          for anim_collector in sampled_collectors]))
+            for frame in frames:
+                bpy.context.scene.frame_set(frame)
+                for anim_collector in sampled_collectors:
+                    if frame in anim_collector.frames and \
+                            anim_collector.sampled_frames[frame - anim_collector.start_f]:
+                        anim_collector.record_frame(frame)
+
+            for anim_collector in anim_collectors:
+                anim_collector.finish()
+        finally:
+            for id_data, old_action in assigned_actions.items():
+                if old_action is None:
+                    id_data.animation_data_clear()
+                else:
+                    id_data.animation_data.action = old_action
+
+    def evaluate_direct(self, anim_collectors):
+        """
+        Record the targets, which can be computed straight from the F-curves, without
+        evaluating the scene. Only the sampled frames of the collectors are evaluated.
+        The rest is left for frame_set() sampling.
+
+        @param anim_collectors: list of AnimCollector, which use the current action.
+        """
+        collector_frames = {anim_collector: np.array(anim_collector.frames)[anim_collector.sampled_frames].tolist()
+                            for anim_collector in anim_collectors}
+        frames = sorted(set().union(*collector_frames.values()))
+        positions = {frame: idx for idx, frame in enumerate(frames)}
+
+        def collector_slice(anim_collector, values):
+            return [values[positions[frame]] for frame in collector_frames[anim_collector]]
+
+        armatures = {}
+        morph_targets = {}
+        sampled_bones = {}
+        for anim_collector in anim_collectors:
+            armatures.update((arm.name, arm) for arm in anim_collector.armatures)
+            morph_targets.update((obj.name, obj) for obj in anim_collector.morph_targets)
+            for arm in anim_collector.armatures:
+                sampled_bones.setdefault(arm.name, set()).update(
+                    bone.name for bone, sampled in zip(arm.pose.bones, anim_collector.sampled_bones[arm.name])
+                    if sampled)
+
+        for arm in armatures.values():
+            fcurves = get_action_fcurves(arm)
+            bone_names = get_direct_bones(arm, fcurves) & sampled_bones[arm.name]
+            print('INFO: %s: %i of %i bones are evaluated from F-curves' %
+                  (arm.name, len(bone_names), len(sampled_bones[arm.name])))
+            if not bone_names:
+                continue
+            pose_matrices = evaluate_pose_matrices(arm, bone_names, fcurves, frames)
+            for anim_collector in anim_collectors:
+                if arm in anim_collector.armatures:
+                    anim_collector.record_direct_bones(arm, {name: collector_slice(anim_collector, matrices)
+                                                             for name, matrices in pose_matrices.items()})
+
+        for obj in morph_targets.values():
+            values = evaluate_shape_keys(obj, frames)
+            if values is None:
+                print('INFO: %s: shapekeys are driven, sampling them frame by frame' % obj.name)
+                continue
+            for anim_collector in anim_collectors:
+                if obj in anim_collector.morph_targets:
+                    anim_collector.record_direct_morph(obj, {name: collector_slice(anim_collector, key_values)
+                                                             for name, key_values in values.items()})
 
 
 # -----------------------------------------------------------------------
@@ -1179,29 +2228,35 @@ def get_used_materials(objects):
         if obj.type != 'MESH':
             continue
 
-        for face in obj.data.polygons:
-            if face.material_index < len(obj.data.materials):
-                if not obj.data.materials[face.material_index]:
+        mesh = EXPORT_MESHES.get(obj.name, obj.data)
+        for face in mesh.polygons:
+            if face.material_index < len(mesh.materials):
+                if not mesh.materials[face.material_index]:
                     continue
-                mat_list.append(obj.data.materials[face.material_index].yabee_name)
+                mat_list.append(mesh.materials[face.material_index].name)
 
     return set(mat_list)
 
 
-def get_egg_materials_str(object_names=None):
+def get_egg_materials_str(object_names=None, objects=None):
     """
     Return the EGG string of used materials
+
+    @param object_names: names of the scene objects, the selected objects if empty.
+    @param objects: Blender's objects to use instead of object_names.
+    @return: tuple (EGG string, used materials, used textures).
     """
-    if not object_names:
-        objects = bpy.context.selected_objects
-    else:
-        objects = []
-        for name in object_names:
-            for obj in bpy.context.scene.objects:
-                if obj.yabee_name == name:
-                    objects.append(obj)
+    if objects is None:
+        if not object_names:
+            objects = bpy.context.selected_objects
+        else:
+            objects = []
+            for name in object_names:
+                for obj in bpy.context.scene.objects:
+                    if obj.name == name:
+                        objects.append(obj)
     if not objects:
-        return ''
+        return '', set(), {}
 
     mat_str = ''
     used_materials = get_used_materials(objects)
@@ -1210,7 +2265,7 @@ def get_egg_materials_str(object_names=None):
     containsPBRNodes = False
     for m_idx in used_materials:
         mat = bpy.data.materials[m_idx]
-        mat_str += '<Material> %s {\n' % eggSafeName(mat.yabee_name)
+        mat_str += '<Material> %s {\n' % eggSafeName(mat.name)
         # MARK
 
         matIsFancyPBRNode = False
@@ -1352,49 +2407,26 @@ def hierarchy_to_list(obj, hierarchy, base_filter=None):
             hierarchy_to_list(child, hierarchy, base_filter)
 
 
-def merge_objects():
-    """
-    Merge objects, which armatured by single Armature.
+def get_included_armatures(obj_list):
     """
-    join_to_arm = {}
-    selection = []
-
-    for selected_obj in bpy.context.selected_objects:
-        # If our selected object has an armature modifier, this will be True
-        to_join = False
-
-        if selected_obj.type == 'MESH':
-            for mod in selected_obj.modifiers:
-                # This mesh has an armature modifier on it, therefore it is an actor.
-                if mod and mod.type == 'ARMATURE':
-                    # what differentiates mod.object from selected_obj.?
-                    # what is mod.object?
-                    if mod.object not in join_to_arm.keys():
-                        join_to_arm[mod.object] = []
-
-                    join_to_arm[mod.object].append(selected_obj)
-                    to_join = True
-
-        if not to_join:
-            selection.append(selected_obj)
-
-    # These objects are our lineup Actors
-    for actor_obj in join_to_arm.values():
-        bpy.ops.object.select_all(action = 'DESELECT')
-        for actor_child_obj in actor_obj:
-            actor_child_obj.select = True
+    Find the armatures, which the objects need, but which are not in the list:
+    the armatures of the actors and the parents of the bone parented objects.
 
-        if len(bpy.context.selected_objects[:]) > 1:
-            bpy.context.scene.objects.active = bpy.context.selected_objects[0]
-            bpy.ops.object.join()
-
-        # Build our ultimate node selection...
-        selection += bpy.context.selected_objects[:]
-
-    bpy.ops.object.select_all(action = 'DESELECT')
-
-    for obj in selection:
-        obj.select = True
+    @param obj_list: list of the exported objects.
+    @return: list of the armatures to add to the export.
+    """
+    included_armature = []
+    for obj in obj_list:
+        for mod in obj.modifiers:
+            if mod and mod.type == 'ARMATURE' \
+                    and mod.object not in included_armature \
+                    and mod.object not in obj_list:
+                included_armature.append(mod.object)
+        if obj.parent and obj.parent_type == 'BONE' \
+                and obj.parent not in included_armature \
+                and obj.parent not in obj_list:
+            included_armature.append(obj.parent)
+    return included_armature
 
 
 def parented_to_armatured():
@@ -1432,50 +2464,333 @@ def parented_to_armatured():
         obj.select = True
 
 
-def reparenting_to_armature(obj_list):
-    for obj in obj_list:
-        for mod in obj.modifiers:
-            if mod and mod.type == 'ARMATURE' and mod.show_viewport:
-                if mod.object and obj.parent != mod.object:
-                    print('WARNING:Reparent %s to %s' % (obj.yabee_name, mod.object.yabee_name))
-                    m = Matrix(obj.matrix_world)
-                    obj.parent = mod.object
-                    obj.matrix_world = m
+def get_export_parent(obj):
+    """
+    Return the parent of the object in the exported hierarchy. Objects, deformed by an
+    armature, are placed under the armature, so the joints are found by the actor.
+
+    @param obj: Blender's object.
+    @return: parent object or None.
+    """
+    for mod in obj.modifiers:
+        if mod.type == 'ARMATURE' and mod.show_viewport and mod.object:
+            return mod.object
+    return obj.parent
 
 
-def apply_modifiers(obj_list=None):
-    if not obj_list:
-        obj_list = bpy.context.selected_objects
+def get_kept_joints(obj_list):
+    """
+    Find the bones, which matter for the exported objects: the bones with the vertex
+    weights, the bones with the attached objects and their parents. Armatures, which
+    deform and carry nothing, keep all bones.
+
+    @param obj_list: list of the exported objects, the actors data must be already created.
+    @return: dict {armature name: set of the kept bone names}.
+    """
+    kept_joints = {}
+    for arm in obj_list:
+        if arm.type != 'ARMATURE':
+            continue
+        used = set(get_skeleton(arm).vrefs)
+        for obj in obj_list:
+            if obj.parent == arm and obj.parent_type == 'BONE':
+                used.add(obj.parent_bone)
+        used.intersection_update(arm.data.bones.keys())
+        if not used:
+            continue
+        for name in list(used):
+            used.update(bone.name for bone in arm.data.bones[name].parent_recursive)
+        print('INFO: %s: %i of %i joints are kept' % (arm.name, len(used), len(arm.data.bones)))
+        kept_joints[arm.name] = used
+    return kept_joints
+
 
+def evaluate_meshes(objects, depsgraph):
+    """
+    Make the temporary meshes of the evaluated objects in one depsgraph update. The
+    Armature modifiers are switched off for the time of evaluation, the skinning
+    is done by Panda's joints.
+
+    @param objects: list of Blender's mesh objects.
+    @param depsgraph: evaluated dependency graph.
+    @return: dict {object name: new mesh datablock}, meshes should be removed by the caller.
+    """
+    armature_mods = [mod for obj in objects for mod in obj.modifiers
+                     if mod.type == 'ARMATURE' and mod.show_viewport]
+    for mod in armature_mods:
+        mod.show_viewport = False
+    try:
+        depsgraph.update()
+        meshes = {}
+        for obj in objects:
+            meshes[obj.name] = bpy.data.meshes.new_from_object(obj.evaluated_get(depsgraph),
+                                                               preserve_all_data_layers = True,
+                                                               depsgraph = depsgraph)
+        return meshes
+    finally:
+        for mod in armature_mods:
+            mod.show_viewport = True
+
+
+def triangulate_ngons(mesh):
+    """
+    Triangulate polygons with more than 4 corners. calc_tangents() works with tris and quads only.
+
+    @param mesh: mesh datablock to modify.
+    @return: True if mesh has been changed.
+    """
+    bm = bmesh.new()
+    try:
+        bm.from_mesh(mesh)
+        ngons = [face for face in bm.faces if len(face.verts) > 4]
+        if ngons:
+            bmesh.ops.triangulate(bm, faces = ngons)
+            bm.to_mesh(mesh)
+        return bool(ngons)
+    finally:
+        bm.free()
+
+
+def get_mesh_hash(mesh):
+    """
+    Hash everything of the mesh, which goes to the EGG: topology, local coordinates,
+    normals, UV layers, vertex colors and materials.
+
+    @param mesh: Blender's mesh.
+    @return: hex digest string.
+    """
+    content = hashlib.blake2b(digest_size = 16)
+    arrays = [
+        foreach_get_array(mesh.vertices, 'co', width = 3),
+        foreach_get_array(mesh.vertices, 'normal', width = 3),
+        foreach_get_array(mesh.edges, 'vertices', np.int32, width = 2),
+        foreach_get_array(mesh.edges, 'use_edge_sharp', bool),
+        foreach_get_array(mesh.loops, 'vertex_index', np.int32),
+        foreach_get_array(mesh.polygons, 'loop_total', np.int32),
+        foreach_get_array(mesh.polygons, 'material_index', np.int32),
+        foreach_get_array(mesh.polygons, 'use_smooth', bool),
+    ]
+    for uv_layer in mesh.uv_layers:
+        content.update(('%s %s' % (uv_layer.name, uv_layer.active)).encode())
+        arrays.append(foreach_get_array(uv_layer.data, 'uv', width = 2))
+    if mesh.vertex_colors.active:
+        arrays.append(foreach_get_array(mesh.vertex_colors.active.data, 'color', width = 4))
+    if USE_LOOP_NORMALS and mesh.has_custom_normals:
+        if hasattr(mesh, 'calc_normals_split'):
+            mesh.calc_normals_split()
+        arrays.append(foreach_get_array(mesh.loops, 'normal', width = 3))
+    for array in arrays:
+        content.update(repr(array.shape).encode())
+        content.update(array.tobytes())
+    content.update(repr([mat.name if mat else None for mat in mesh.materials]).encode())
+    content.update(repr(getattr(mesh, 'use_auto_smooth', None)).encode())
+    return content.hexdigest()
+
+
+def collect_shared_meshes(obj_list):
+    """
+    Find the meshes, used by several exported objects: linked to them or just identical
+    copies, found by the content hash. Only the static meshes qualify: objects without
+    modifiers, shapekeys and object linked materials.
+
+    @param obj_list: list of the exported objects.
+    @return: dict {object name: (mesh EGG file name, object, which writes the mesh)}.
+    """
+    users = {}
+    mesh_hashes = {}
     for obj in obj_list:
-        for mod in obj.modifiers:
-            if mod and mod.type != 'ARMATURE' and mod.show_viewport:
-                obj = bpy.context.window.scene.objects[0]
-                bpy.context.view_layer.objects.active = obj
-                try:
-                    bpy.ops.object.modifier_apply(modifier = mod.name)
-                    print('INFO: Applying modifier', mod.name)
-                except:
-                    print('WARNING: Can\'t apply modifier', mod.name)
-
-
-def generate_shadow_uvs():
-    auvs = {}
-    for obj in [obj for obj in bpy.context.selected_objects if obj.type == 'MESH']:
-        auvs[obj.name] = obj.data.uv_layers.active
-        if 'yabee_shadow' not in obj.data.uv_layers.keys():
-            obj.data.uv_layers.new('yabee_shadow')
-        # else:
-        #    obj.data.uv_layers.active = obj.data.uv_layers['yabee_shadow']
-        #    obj.data.uv_layers.active = obj.data.uv_layers['yabee_shadow']
-    # bpy.ops.object.mode_set.poll()
-    obj.data.uv_layers.active = obj.data.uv_layers['yabee_shadow']
-    obj.data.update()
-    bpy.ops.uv.smart_project(angle_limit = 66, island_margin = 0.03)
-    for obj in [obj for obj in bpy.context.selected_objects if obj.type == 'MESH']:
-        obj.data.uv_layers.active = auvs[obj.name]
-        obj.data.update()
-    bpy.context.scene.update()
+        if obj.type != 'MESH' or obj.modifiers or obj.data.shape_keys or obj.name in EXPORT_MESHES:
+            continue
+        if [slot for slot in obj.material_slots if slot.link == 'OBJECT']:
+            continue
+        if obj.data not in mesh_hashes:
+            mesh_hashes[obj.data] = get_mesh_hash(obj.data)
+        users.setdefault(mesh_hashes[obj.data], []).append(obj)
+
+    base_name = os.path.basename(FILE_PATH)
+    if base_name[-4:].upper() == '.EGG':
+        base_name = base_name[:-4]
+    shared_meshes = {}
+    file_names = set()
+    for objects in users.values():
+        if len(objects) < 2:
+            continue
+        mesh = objects[0].data
+        file_name = '%s-%s.egg' % (base_name, re.sub(r'[^\w.-]', '_', mesh.name))
+        idx = 1
+        while file_name in file_names:
+            file_name = '%s-%s.%i.egg' % (base_name, re.sub(r'[^\w.-]', '_', mesh.name), idx)
+            idx += 1
+        file_names.add(file_name)
+        copies = len({obj.data for obj in objects})
+        print('INFO: %s: mesh is shared by %i objects (%i identical meshes)' % (mesh.name, len(objects), copies))
+        for obj in objects:
+            shared_meshes[obj.name] = (file_name, objects[0])
+    return shared_meshes
+
+
+def write_shared_meshes():
+    """
+    Write the meshes from SHARED_MESHES to their EGG files next to the main file.
+
+    @return: list of the written file paths.
+    """
+    fdir = os.path.dirname(os.path.abspath(FILE_PATH))
+    written = []
+    users = {}
+    for file_name, obj in SHARED_MESHES.values():
+        users[file_name] = users.get(file_name, 0) + 1
+    saved_bytes = 0
+    saved_vertices = 0
+    for file_name, obj in sorted(set(SHARED_MESHES.values()), key = lambda item: item[0]):
+        path = os.path.join(fdir, file_name)
+        with open(path, 'w') as file:
+            file.write('<CoordinateSystem> { Z-up } \n')
+            file.write(get_egg_materials_str([obj.name])[0])
+            mesh_data = EGGSharedMeshObjectData(obj)
+            mesh_data.write_egg(EGGStream(file))
+        written.append(path)
+        saved_bytes += os.path.getsize(path) * (users[file_name] - 1)
+        saved_vertices += len(mesh_data.pool_loops) * (users[file_name] - 1)
+    if written:
+        print('INFO: Shared meshes saved %i vertices and %i bytes' % (saved_vertices, saved_bytes))
+    return written
+
+
+def get_collection_file_name(collection):
+    """
+    Register the instanced collection for write_instanced_collections().
+
+    @param collection: Blender's collection.
+    @return: name of the collection EGG file, next to the main file.
+    """
+    if collection.name not in INSTANCED_COLLECTIONS:
+        # Different names may give the same file name after the sanitizing
+        file_names = {file_name.upper() for file_name, _ in INSTANCED_COLLECTIONS.values()}
+        file_names.add(os.path.basename(FILE_PATH).upper())
+        safe_name = re.sub(r'[^\w.-]', '_', collection.name)
+        file_name = safe_name + '.egg'
+        idx = 1
+        while file_name.upper() in file_names:
+            file_name = '%s.%i.egg' % (safe_name, idx)
+            idx += 1
+        INSTANCED_COLLECTIONS[collection.name] = (file_name, collection)
+    return INSTANCED_COLLECTIONS[collection.name][0]
+
+
+def write_instanced_collections():
+    """
+    Write the collections from INSTANCED_COLLECTIONS to their EGG files next to the main
+    file. Collections, instanced inside of them, are registered and written in turn.
+    The collection's instance offset is the origin of the file.
+
+    @return: list of the written file paths.
+    """
+    fdir = os.path.dirname(os.path.abspath(FILE_PATH))
+    written = {}
+    while len(written) < len(INSTANCED_COLLECTIONS):
+        for name, (file_name, collection) in list(INSTANCED_COLLECTIONS.items()):
+            if name in written:
+                continue
+            written[name] = None
+            if not collection.all_objects:
+                print('WARNING: Collection %s is empty' % name)
+                continue
+            path = os.path.join(fdir, file_name)
+            if write_collection_egg(collection, path):
+                written[name] = path
+    return [path for path in written.values() if path]
+
+
+def write_collection_egg(collection, path):
+    """
+    Write the collection's objects to the EGG file. The file gets its own materials,
+    skeletons and merged actors: the caches of the main file are set aside while writing.
+
+    @param collection: Blender's collection.
+    @param path: path of the EGG file.
+    @return: True if the file is written.
+    """
+    global USED_MATERIALS, USED_TEXTURES
+    objects = list(collection.all_objects)
+    objects += get_included_armatures(objects)
+    saved = (USED_MATERIALS, USED_TEXTURES, dict(SKELETONS), dict(MERGED_ACTORS))
+    SKELETONS.clear()
+    MERGED_ACTORS.clear()
+    try:
+        collect_export_meshes([obj for obj in objects if obj.name not in EXPORT_MESHES])
+        materials_str, USED_MATERIALS, USED_TEXTURES = get_egg_materials_str(objects = objects)
+        gr = Group(None)
+        if gr.make_hierarchy_from_list(objects):
+            print('ERROR: Can\'t export the collection %s' % collection.name)
+            return False
+        gr.update_joints_data()
+
+        with open(path, 'w') as file:
+            file.write('<CoordinateSystem> { Z-up } \n')
+            file.write(materials_str)
+            stream = EGGStream(file)
+            offset = collection.instance_offset
+            if offset.length:
+                stream.open('<Instance>')
+                stream.open('<Transform>')
+                stream.write_line('<Translate> { %s }' % STRF.join(-np.array(offset)))
+                stream.close()
+            gr.write_egg(stream)
+            if offset.length:
+                stream.close()
+        return True
+    finally:
+        USED_MATERIALS, USED_TEXTURES = saved[:2]
+        SKELETONS.clear()
+        SKELETONS.update(saved[2])
+        MERGED_ACTORS.clear()
+        MERGED_ACTORS.update(saved[3])
+
+
+def collect_export_meshes(obj_list):
+    """
+    Fill EXPORT_MESHES with the meshes to export instead of obj.data. The user's
+    scene and data are never changed, only temporary meshes are created.
+
+    @param obj_list: list of objects for export.
+    """
+    mesh_objects = [obj for obj in obj_list if obj.type == 'MESH']
+    for obj in mesh_objects:
+        if obj.mode == 'EDIT':
+            obj.update_from_editmode()
+
+    modified = []
+    if APPLY_MOD:
+        for obj in mesh_objects:
+            if [mod for mod in obj.modifiers if mod.type != 'ARMATURE' and mod.show_viewport]:
+                if obj.data.shape_keys:
+                    print('WARNING: Can\'t apply modifiers to %s with shape keys' % obj.name)
+                else:
+                    modified.append(obj)
+    if modified:
+        print('INFO: Applying modifiers of', [obj.name for obj in modified])
+        EXPORT_MESHES.update(evaluate_meshes(modified, bpy.context.evaluated_depsgraph_get()))
+
+    if CALC_TBS == 'BLENDER':
+        for obj in mesh_objects:
+            mesh = EXPORT_MESHES.get(obj.name)
+            if not mesh:
+                if obj.data.shape_keys or \
+                        foreach_get_array(obj.data.polygons, 'loop_total', np.int32).max(initial = 0) <= 4:
+                    continue
+                mesh = EXPORT_MESHES[obj.name] = obj.data.copy()
+            if triangulate_ngons(mesh):
+                print('WARNING:TBS: Triangulate %s to avoid non tris/quads polygons' % obj.name)
+
+
+def free_export_meshes():
+    """
+    Remove temporary meshes, created by collect_export_meshes().
+    """
+    for mesh in EXPORT_MESHES.values():
+        bpy.data.meshes.remove(mesh)
+    EXPORT_MESHES.clear()
 
 
 # -----------------------------------------------------------------------
@@ -1483,12 +2798,17 @@ def generate_shadow_uvs():
 # -----------------------------------------------------------------------
 def write_out(fname, anims, from_actions, uv_img_as_tex, sep_anim, a_only,
               copy_tex, t_path, tbs, tex_processor, b_layers,
-              m_actor, apply_m, pview, loop_normals, export_pbs, force_export_vertex_colors, objects=None):
+              m_actor, apply_m, pview, loop_normals, export_pbs, force_export_vertex_colors, objects=None,
+              weld_vertices=False, max_influences=0, weight_bits=0, float_accuracy=6, direct_fcurves=True,
+              compact_anims=True, anim_tolerances=None, skip_static_frames=False, prune_joints=False,
+              instance_meshes=False, instance_collections=False):
     global FILE_PATH, ANIMATIONS, ANIMS_FROM_ACTIONS, EXPORT_UV_IMAGE_AS_TEXTURE, \
         COPY_TEX_FILES, TEX_PATH, SEPARATE_ANIM_FILE, ANIM_ONLY, \
         STRF, CALC_TBS, TEXTURE_PROCESSOR, BAKE_LAYERS, \
         MERGE_ACTOR_MESH, APPLY_MOD, PVIEW, USED_MATERIALS, USED_TEXTURES, \
-        USE_LOOP_NORMALS, EXPORT_PBS, FORCE_EXPORT_VERTEX_COLORS
+        USE_LOOP_NORMALS, EXPORT_PBS, FORCE_EXPORT_VERTEX_COLORS, WELD_VERTICES, MAX_INFLUENCES, \
+        WEIGHT_BITS, DIRECT_FCURVES, COMPACT_ANIMS, ANIM_TOLERANCES, SKIP_STATIC_FRAMES, PRUNE_JOINTS, KEPT_JOINTS, \
+        INSTANCE_MESHES, INSTANCE_COLLECTIONS
     importlib.reload(sys.modules[lib_name + '.texture_processor'])
     importlib.reload(sys.modules[lib_name + '.utils'])
     errors = []
@@ -1510,137 +2830,42 @@ def write_out(fname, anims, from_actions, uv_img_as_tex, sep_anim, a_only,
     USE_LOOP_NORMALS = loop_normals
     EXPORT_PBS = export_pbs
     FORCE_EXPORT_VERTEX_COLORS = force_export_vertex_colors
-    s_acc = '%.6f'
-
-    def str_f(x):
-        return s_acc % x
-
-    STRF = str_f
-    # Prepare copy of the scene.
-    # Sync objects names with custom property "yabee_name" to be able to get basic object name in the copy of the scene.
-    # selected_obj = [obj.name for obj in bpy.context.selected_objects if obj.type != 'ARMATURE']
-
-    # i'm not sure if objects is ever not None
+    WELD_VERTICES = weld_vertices
+    MAX_INFLUENCES = max_influences
+    WEIGHT_BITS = weight_bits
+    DIRECT_FCURVES = direct_fcurves
+    COMPACT_ANIMS = compact_anims
+    ANIM_TOLERANCES = anim_tolerances
+    SKIP_STATIC_FRAMES = skip_static_frames
+    PRUNE_JOINTS = prune_joints
+    INSTANCE_MESHES = instance_meshes
+    INSTANCE_COLLECTIONS = instance_collections
+    KEPT_JOINTS = {}
+    STRF = FloatFormatter(float_accuracy)
+    # Objects are exported as they are, modified meshes are evaluated into the
+    # temporary meshes, which are removed after export.
     selected_obj = objects
     if not selected_obj:
         selected_obj = [obj.name for obj in bpy.context.selected_objects]
 
-    for obj in bpy.data.objects:
-        obj.yabee_name = obj.name
-
-    for item in (bpy.data.meshes, bpy.data.textures, bpy.data.curves, bpy.data.shape_keys, bpy.data.images):
-        for obj in item:
-            obj.yabee_name = obj.name
-
-    # Looping the node tree to get texture and its name
-    for mat in bpy.data.materials:
-        mat.yabee_name = mat.name
-        ms_names = []
-        for obj in bpy.data.objects:
-            for mat_slot in obj.material_slots:
-                if mat_slot.material and mat_slot.material.node_tree:
-                    for tex in mat_slot.material.node_tree.nodes:
-                        if tex.type == 'TEX_IMAGE':
-                            ms_names.append(tex.image and tex.image.name or "")
-
-    for arm in bpy.data.armatures:
-        arm.yabee_name = arm.name
-        for bone in arm.bones:
-            bone.yabee_name = bone.name
-
-    for obj in bpy.context.scene.objects:
-        if obj.type == 'ARMATURE':
-            for bone in obj.pose.bones:
-                bone.yabee_name = bone.name
-
-    old_data = {}
-    for data in (bpy.data.materials, bpy.data.objects, bpy.data.textures,
-                 bpy.data.armatures, bpy.data.actions, bpy.data.brushes,
-                 bpy.data.cameras, bpy.data.curves, bpy.data.collections,
-                 bpy.data.images, bpy.data.lights, bpy.data.meshes,
-                 bpy.data.metaballs, bpy.data.movieclips,
-                 bpy.data.node_groups, bpy.data.particles, bpy.data.screens,
-                 bpy.data.shape_keys, bpy.data.sounds,
-                 bpy.data.speakers, bpy.data.texts, bpy.data.window_managers,
-                 bpy.data.worlds, bpy.data.grease_pencils):
-        old_data[data] = data[:]
-
-    # we need this?
-    precopy_obj_list = None
-
-    if USE_LOOP_NORMALS:
-        # even obj.data.copy() will not contain loop normals
-        precopy_obj_list = [obj for obj in bpy.context.scene.objects if obj.yabee_name in selected_obj]
-
-    bpy.ops.scene.new(type = 'FULL_COPY')
     try:
-        obj_list = [obj for obj in bpy.context.scene.objects if obj.yabee_name in selected_obj]
-        if USE_LOOP_NORMALS:
-            for old, new in zip(precopy_obj_list, obj_list):
-                if old.type != "MESH":
-                    continue
-                print("{} has custom normals!".format(
-                    old.name) if old.data.has_custom_normals else "{} has no custom normals.".format(old.name))
-                bpy.context.scene.objects.active = new
-                bpy.ops.object.modifier_add(type = 'DATA_TRANSFER')
-                bpy.context.object.modifiers["DataTransfer"].object = old
-                bpy.context.object.modifiers["DataTransfer"].use_loop_data = True
-                # bpy.context.object.modifiers["DataTransfer"].loop_mapping = 'POLYINTERP_LNORPROJ'
-                bpy.context.object.modifiers["DataTransfer"].loop_mapping = 'TOPOLOGY'
-                bpy.context.object.modifiers["DataTransfer"].data_types_loops = {'CUSTOM_NORMAL'}
-                bpy.ops.object.modifier_apply(apply_as = 'DATA', modifier = "DataTransfer")
-                new.data.calc_normals_split()
-
-        if CALC_TBS == 'BLENDER':
-            for obj in obj_list:
-                if not hasattr(obj.data, "polygons"):
-                    print('WARNING: Skipping non-geometry object:', obj.name)
-                    continue
-
-                for face in obj.data.polygons:
-                    if len(face.vertices) > 4:
-                        obj.modifiers.new('triangulate_for_TBS', 'TRIANGULATE')
-                        print('WARNING:TBS: Triangulate %s to avoid non tris/quads polygons' % obj.yabee_name)
-                        bpy.context.scene.objects.active = obj
-                        bpy.ops.object.modifier_apply(modifier = 'triangulate_for_TBS')
-                        break
-
-        if APPLY_MOD:
-            apply_modifiers(obj_list)
-
-        reparenting_to_armature(obj_list)
-        # parented_to_armatured()
-        # if MERGE_ACTOR_MESH:
-        #    merge_objects()
-        if bpy.ops.object.mode_set.poll():
-            bpy.ops.object.mode_set(mode = 'OBJECT')
-
-        # Generate UV layers for shadows
-        if BAKE_LAYERS and (BAKE_LAYERS['AO'][2] or BAKE_LAYERS['shadow'][2]):
-            generate_shadow_uvs()
+        obj_list = [obj for obj in bpy.context.scene.objects if obj.name in selected_obj]
+        collect_export_meshes(obj_list)
+        if INSTANCE_MESHES:
+            SHARED_MESHES.update(collect_shared_meshes(obj_list))
 
         gr = Group(None)
 
-        included_armature = []
-        for obj in bpy.context.scene.objects:
-            if obj.yabee_name in selected_obj:
-                for mod in obj.modifiers:
-                    if mod and mod.type == 'ARMATURE' \
-                            and mod.object not in included_armature \
-                            and mod.object not in obj_list:
-                        included_armature.append(mod.object)
-                if obj.parent and obj.parent_type == 'BONE' \
-                        and obj.parent not in included_armature \
-                        and obj.parent not in obj_list:
-                    included_armature.append(obj.parent)
-
-        obj_list += included_armature
+        obj_list += get_included_armatures(obj_list)
         # print("DEBUG: ", obj_list)
-        print('Objects for export:', [obj.yabee_name for obj in obj_list])
+        print('Objects for export:', [obj.name for obj in obj_list])
 
         errors += gr.make_hierarchy_from_list(obj_list)
         if not errors:
             # gr.print_hierarchy()
+            if PRUNE_JOINTS:
+                KEPT_JOINTS = get_kept_joints(obj_list)
+                gr.prune_joints(KEPT_JOINTS)
             gr.update_joints_data()
 
             fdir, fname = os.path.split(os.path.abspath(FILE_PATH))
@@ -1652,11 +2877,19 @@ def write_out(fname, anims, from_actions, uv_img_as_tex, sep_anim, a_only,
             print('WRITE main EGG to %s' % os.path.abspath(FILE_PATH))
             if (not ANIM_ONLY) or (not SEPARATE_ANIM_FILE):
                 file = open(FILE_PATH, 'w')
+                stream = EGGStream(file)
+            shared_paths = []
             if not ANIM_ONLY:
                 file.write('<CoordinateSystem> { Z-up } \n')
                 materials_str, USED_MATERIALS, USED_TEXTURES = get_egg_materials_str(selected_obj)
                 file.write(materials_str)
-                file.write(gr.get_full_egg_str())
+                gr.write_egg(stream)
+                shared_paths += write_shared_meshes()
+                for path in shared_paths:
+                    print('WRITE shared mesh EGG to %s' % path)
+                for path in write_instanced_collections():
+                    print('WRITE collection EGG to %s' % path)
+                    shared_paths.append(path)
 
             anim_collectors = []
             if ANIMS_FROM_ACTIONS:
@@ -1664,33 +2897,40 @@ def write_out(fname, anims, from_actions, uv_img_as_tex, sep_anim, a_only,
                 fps = bpy.context.scene.render.fps / bpy.context.scene.render.fps_base
 
                 for action in bpy.data.actions:
+                    targets = get_action_targets(action, obj_list)
+                    if not targets:
+                        print('INFO: Skip action %s: no matching bones or shape keys' % action.name)
+                        continue
                     frange = action.frame_range
-                    ac = AnimCollector(obj_list, int(frange[0]), int(frange[1]) + 1, fps, action.name, action)
+                    ac = AnimCollector(targets, int(frange[0]), int(frange[1]) + 1, fps, action.name, action)
                     anim_collectors.append(ac)
             else:
                 # Export animations named in ANIMATIONS dictionary.
                 for a_name, frames in ANIMATIONS.items():
-                    ac = AnimCollector(obj_list, frames[0], frames[1], frames[2], a_name)
+                    bone_mask = frames[3] if len(frames) > 3 else None
+                    ac = AnimCollector(obj_list, frames[0], frames[1], frames[2], a_name, bone_mask = bone_mask)
                     anim_collectors.append(ac)
+            AnimSampler(anim_collectors).run()
+            if ANIM_TOLERANCES:
+                for anim_collector in anim_collectors:
+                    anim_collector.simplify(*ANIM_TOLERANCES)
 
             fpa = []
             for anim_collector in anim_collectors:
                 if not SEPARATE_ANIM_FILE:
                     if ANIM_ONLY:
                         file.write('<CoordinateSystem> { Z-up } \n')
-                    file.write(anim_collector.get_full_egg_str())
+                    anim_collector.write_egg(stream)
                 else:
                     anim_path = FILE_PATH
                     if anim_path[-4:].upper() == '.EGG':
                         anim_path = anim_path[:-4] + '-' + anim_collector.name + anim_path[-4:]
                     else:
                         anim_path = anim_path + '-' + anim_collector.name + '.egg'
-                    a_egg_str = anim_collector.get_full_egg_str()
-                    if len(a_egg_str) > 0:
-                        a_file = open(anim_path, 'w')
-                        a_file.write('<CoordinateSystem> { Z-up } \n')
-                        a_file.write(anim_collector.get_full_egg_str())
-                        a_file.close()
+                    if anim_collector.obj_anim_ref:
+                        with open(anim_path, 'w') as a_file:
+                            a_file.write('<CoordinateSystem> { Z-up } \n')
+                            anim_collector.write_egg(EGGStream(a_file))
                         fpa.append(anim_path)
 
             if not ANIM_ONLY or not SEPARATE_ANIM_FILE:
@@ -1698,9 +2938,9 @@ def write_out(fname, anims, from_actions, uv_img_as_tex, sep_anim, a_only,
 
             if CALC_TBS == 'PANDA':
                 try:
-                    fp = os.path.abspath(FILE_PATH)
-                    for line in os.popen('egg-trans -tbnall -ps keep -o "%s" "%s"' % (fp, fp)).readlines():
-                        print(line)
+                    for fp in [os.path.abspath(FILE_PATH)] + shared_paths:
+                        for line in os.popen('egg-trans -tbnall -ps keep -o "%s" "%s"' % (fp, fp)).readlines():
+                            print(line)
                 except:
                     print('ERROR: Can\'t calculate TBS through panda\'s egg-trans')
             if PVIEW:
@@ -1713,22 +2953,12 @@ def write_out(fname, anims, from_actions, uv_img_as_tex, sep_anim, a_only,
         errors.append('ERR_UNEXPECTED')
         # print('\n'.join(format_tb(exc.__traceback__)))
         print_exc()
-    # Clearing the scene.
-    # (!) Possible Incomplete.
-    # Whenever we are deleted our copy of the scene,
-    # Blender won't to delete other objects, created with the scene, so
-    # we should do it by hand. I recommend to save the .blend file before
-    # exporting and reload it after.
-    bpy.ops.scene.delete()
-    for data in old_data:
-        for obj in data:
-            if obj not in old_data[data]:
-                # print("{} has {} users. Proceeding to clear.".format(obj.name, obj.users))
-                obj.user_clear()
-                try:
-                    data.remove(obj, do_unlink = True)
-                except:
-                    print('WARNING: Can\'t delete', obj, 'from', data)
+    finally:
+        free_export_meshes()
+        SKELETONS.clear()
+        MERGED_ACTORS.clear()
+        SHARED_MESHES.clear()
+        INSTANCED_COLLECTIONS.clear()
     return errors
 
 
@@ -240,7 +240,7 @@ class TextureBaker:
         for obj in self.obj_list:
             if obj.type == 'MESH' and self.get_active_uv(obj):
                 self._save_obj_props(obj)
-                img = bpy.data.images.new(obj.yabee_name + '_' + btype, tsizex, tsizey)
+                img = bpy.data.images.new(obj.name + '_' + btype, tsizex, tsizey)
                 self.rendered_images[obj.name] = img.name
                 active_uv = self.get_active_uv(obj)
                 active_uv_idx = obj.data.uv_textures[:].index(active_uv)
@@ -248,7 +248,7 @@ class TextureBaker:
                     for uvd in active_uv.data:
                         # uvd.use_image = True
                         uvd.image = img
-                    assigned_data[obj.yabee_name + '_' + btype] = (active_uv, img, active_uv_idx, BAKE_TYPES[btype][1])
+                    assigned_data[obj.name + '_' + btype] = (active_uv, img, active_uv_idx, BAKE_TYPES[btype][1])
                 else:
                     print('ERROR: %s have not active UV layer' % obj.name)
                     return None
@@ -1,6 +1,11 @@
 import bpy
 import os
+import re
 import bpy_extras
+import numpy as np
+
+# Zeros at the end of the fractional part, with the point itself if nothing is left after it
+TRAILING_ZEROS = re.compile(r'\.?0+(?=\s|$)')
 
 
 def convertFileNameToPanda(filename):
@@ -58,6 +63,178 @@ def save_image(img, file_path, text_path):
     return rel_path
 
 
+def foreach_get_array(collection, attr, dtype=np.float32, width=1):
+    """
+    Read the attribute of every element of the Blender's collection into the NumPy array
+    with the single foreach_get call.
+
+    @param collection: Blender's collection (vertices, loops, polygons, uv_layer.data, ...).
+    @param attr: attribute name.
+    @param dtype: NumPy type of the array. Should match the RNA type to keep foreach_get fast.
+    @param width: number of values per element (3 for coordinates, 2 for UV, ...).
+
+    @return: array of shape (len(collection),) or (len(collection), width).
+    """
+    data = np.empty(len(collection) * width, dtype=dtype)
+    if len(data):
+        collection.foreach_get(attr, data)
+    if width > 1:
+        data = data.reshape((-1, width))
+    return data
+
+
+def transform_points(matrix, points):
+    """
+    Apply the 4x4 transform matrix to the (N, 3) array of points in one batch.
+    """
+    matrix = np.array(matrix, dtype = np.float64)
+    return points @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def get_normal_matrix(matrix):
+    """
+    Return the 3x3 matrix to transform normals with the given 4x4 transform: the inverse-transpose
+    of its linear part. Degenerate (zero scaled) transforms fall back to the linear part itself.
+    """
+    linear = np.array(matrix, dtype = np.float64)[:3, :3]
+    try:
+        return np.linalg.inv(linear).T
+    except np.linalg.LinAlgError:
+        return linear
+
+
+def transform_normals(normal_matrix, normals):
+    """
+    Apply the normal matrix to the (N, 3) array of normals and normalize the result.
+    """
+    normals = normals @ normal_matrix.T
+    length = np.linalg.norm(normals, axis = 1, keepdims = True)
+    return np.divide(normals, length, out = np.zeros_like(normals), where = length > 0)
+
+
+def decompose_matrices(matrices):
+    """
+    Decompose the (..., 4, 4) array of transforms as Matrix.to_scale(), to_euler() and
+    to_translation() do it, in one batch. The Euler angles are XYZ, taken from the matrix
+    with normalized axes, of the two possible solutions the one with the smallest angles
+    is chosen, like Blender does.
+
+    @return: (..., 9) array of scale (ijk), rotation in degrees (prh) and translation (xyz).
+    """
+    matrices = np.asarray(matrices, dtype = np.float64)
+    scale = np.linalg.norm(matrices[..., :3, :3], axis = -2)
+    rot = np.divide(matrices[..., :3, :3], scale[..., None, :],
+                    out = np.zeros(matrices.shape[:-2] + (3, 3)), where = scale[..., None, :] > 0)
+
+    m00, m10, m20 = rot[..., 0, 0], rot[..., 1, 0], rot[..., 2, 0]
+    m11, m12, m21, m22 = rot[..., 1, 1], rot[..., 1, 2], rot[..., 2, 1], rot[..., 2, 2]
+    cy = np.hypot(m00, m10)
+    eul1 = np.stack((np.arctan2(m21, m22), np.arctan2(-m20, cy), np.arctan2(m10, m00)), axis = -1)
+    eul2 = np.stack((np.arctan2(-m21, -m22), np.arctan2(-m20, -cy), np.arctan2(-m10, -m00)), axis = -1)
+    euler = np.where((np.abs(eul1).sum(axis = -1) > np.abs(eul2).sum(axis = -1))[..., None], eul2, eul1)
+    gimbal = np.stack((np.arctan2(-m12, m11), np.arctan2(-m20, cy), np.zeros_like(cy)), axis = -1)
+    euler = np.where((cy > 16 * np.finfo(np.float32).eps)[..., None], euler, gimbal)
+
+    return np.concatenate((scale, np.degrees(euler), matrices[..., :3, 3]), axis = -1)
+
+
+def find_anim_stride(original, simplified, tolerance, max_stride=32):
+    """
+    Find the largest frame stride, with which the animation can be played at the lower fps.
+    Panda holds the sample until the next one, so the frame f shows the sample f // stride.
+    Only the strides, which divide the number of frames, are accepted: the clip of N frames
+    is played for N / stride samples at the lower fps, so its length and loops stay the same.
+    The error doesn't grow monotonically with the stride (keys on every 4th frame fit
+    the stride 4, but not 3), so all strides up to max_stride are checked.
+
+    @param original: (frames, ...) array of the sampled channels.
+    @param simplified: array of the same shape, the channels to resample.
+    @param tolerance: max allowed difference, scalar or array broadcastable to a frame.
+    @param max_stride: the largest stride to check.
+    @return: stride, 1 if the animation can't be resampled.
+    """
+    frames = np.arange(len(original))
+    stride = 1
+    for candidate in range(2, min(len(original), max_stride + 1)):
+        if len(original) % candidate:
+            continue
+        held = simplified[frames // candidate * candidate]
+        if not (np.abs(held - original) > tolerance).any():
+            stride = candidate
+    return stride
+
+
+def quantize_weights(weights, bits):
+    """
+    Quantize the weights to the multiples of 1 / (2 ** bits - 1) and renormalize them.
+    The rounding is done by the largest remainder method, so every row, which has
+    any weight, sums up to exactly 1.
+
+    @param weights: (vertices, influences) array of the weights.
+    @param bits: number of bits per weight.
+    @return: quantized array of the same shape and type.
+    """
+    steps = 2 ** bits - 1
+    totals = weights.sum(axis = 1, dtype = np.float64)
+    weighted = totals > 0
+    scaled = np.zeros(weights.shape)
+    scaled[weighted] = weights[weighted] * (steps / totals[weighted, None])
+    quantized = np.floor(scaled)
+    missing = np.rint(steps - quantized.sum(axis = 1)).astype(np.int64)
+    missing[~weighted] = 0
+    # Rank of every weight by its remainder within the row, the largest first
+    ranks = np.argsort(np.argsort(quantized - scaled, axis = 1, kind = 'stable'), axis = 1)
+    quantized += ranks < missing[:, None]
+    return (quantized / steps).astype(weights.dtype)
+
+
+class FloatFormatter:
+    """
+    Format floats for the EGG output: fixed number of digits after the point, without the
+    trailing zeros ("1.000000" -> "1") and without the negative zero. Whole arrays are
+    formatted per call: one format operation per row and one regular expression pass over the text.
+    """
+
+    def __init__(self, precision=6):
+        """
+        @param precision: number of digits after the point.
+        """
+        self.precision = max(0, int(precision))
+        self.fmt = '%%.%if' % self.precision
+        # Values closer than this are written the same
+        self.tolerance = 0.5 * 10 ** -self.precision
+
+    def __call__(self, value):
+        return self.join((value,))
+
+    def rows(self, values):
+        """
+        Format the (N, M) array.
+
+        @return: list of N strings with M space separated values.
+        """
+        values = np.asarray(values, dtype = np.float64)
+        if not len(values):
+            return []
+        values = values.reshape((len(values), -1))
+        # Adding zero turns the rounded -0.0 to 0.0
+        values = np.round(values, self.precision) + 0.0
+        row_fmt = ' '.join([self.fmt] * values.shape[1])
+        text = '\n'.join([row_fmt % row for row in map(tuple, values.tolist())])
+        if self.precision:
+            text = TRAILING_ZEROS.sub('', text)
+        return text.split('\n')
+
+    def join(self, values):
+        """
+        Format the sequence of values into the single space separated string.
+        """
+        values = np.asarray(values, dtype = np.float64).ravel()
+        if not len(values):
+            return ''
+        return self.rows(values[None, :])[0]
+
+
 def get_active_uv(obj):
     auv = [uv for uv in obj.data.uv_layers if uv.active]
     if auv: